@@ -36,21 +36,32 @@ Packages :
     - Supervisor
     - Virtualenv
     - Sudo
+    - pgbouncer, for servers using a shared PostgreSQL cluster
+    - rsync
 Filesystem (this module system user) :
-    - Write access on configuration directories (openerp, supervisor and apache)
+    - Write access on configuration directories (openerp, supervisor, apache and pgbouncer)
+    - Write access on the wake-up script directory, which must not contain anything else
+    - Membership of the apache group (www-data on Debian), to give the wake-up script to apache only
+    - Write access on the backups directory, and on the filestores directory to restore backups
+    - Read access on the apache access logs directory (adm group on Debian), to detect idle instances
 Filesystem (hosted instances system user) :
     - Write access on PostgreSQL PID directory
     - Write access on filestores directory
+    - Write access on pgbouncer configuration directory, for its PID file
 System (this module system user) :
     - Sudo right for "pg_createcluster"
+    - Sudo right for "pg_ctlcluster" and "pg_dropcluster"
+    - Sudo right for "psql" as the hosted instances system user, to manage the roles and databases of the shared cluster
+    - Sudo right for "pg_dump", "pg_restore" and "createdb" as the hosted instances system user, to back up and restore instances
     - Sudo right for "service apache2 reload"
+    - Sudo right for "apache2ctl configtest"
 Configuration :
     - Add supervisor configuration directory in the [include] section of /etc/supervisor/supervisord.conf
     - Add a file containing an Include directive for the apache configuration directory in /etc/apache2/conf.d/
     - Catchall DNS entry on *.dbname.domain.tld
     - Directive "NameVirtualHost" active for https on apache
     - Activate XML-RPC service on Supervisor
-    - Activate apache2 mods : ssl, proxy_http, headers
+    - Activate apache2 mods : ssl, proxy_http, headers, cgi
 """,
     'author': 'SYLEAM',
     'website': 'http://www.syleam.fr/',
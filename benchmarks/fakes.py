@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    hosting module for OpenERP, Allow to very simply create and manage new OpenERP instances
+#    Copyright (C) 2014 SYLEAM Info Services (<http://www.Syleam.fr/>)
+#              Sylvain Garancher <sylvain.garancher@syleam.fr>
+#
+#    This file is a part of hosting
+#
+#    hosting is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    hosting is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+In memory stand-ins for the hosting servers, used to benchmark the module without real servers
+They replace the SSH connections, SFTP channels and Supervisor XML-RPC clients, and answer to the commands sent by the module
+Each round trip waits for a configurable latency, and is counted
+"""
+
+import re
+import time
+import shlex
+import hashlib
+import threading
+import urlparse
+from collections import defaultdict
+from StringIO import StringIO
+
+PROGRAM = re.compile(r'^\[program:([^\]]+)\]', re.MULTILINE)
+
+
+class Counters(object):
+    """
+    Thread safe counters of round trips
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = defaultdict(int)
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.values[name] += count
+
+    def reset(self):
+        with self._lock:
+            values = dict(self.values)
+            self.values.clear()
+        return values
+
+
+class FakeServer(object):
+    """
+    State of a fake hosting server : files, PostgreSQL clusters and Supervisor processes
+    """
+    def __init__(self, fleet, address):
+        self.fleet = fleet
+        self.address = address
+        self.lock = threading.RLock()
+        self.files = {}
+        # Tuples of (version, name, port, online), keyed by cluster name
+        self.clusters = {}
+        # Supervisor configuration loaded by the last reloadConfig, keyed by program name
+        self.programs = {}
+        # Start time of the running processes, keyed by program name
+        self.running = {}
+
+    def wait(self, name, latency=None):
+        self.fleet.counters.add(name)
+        time.sleep(self.fleet.latency if latency is None else latency)
+
+    def program_configurations(self):
+        with self.lock:
+            configurations = {}
+            for contents in self.files.values():
+                for name in PROGRAM.findall(contents):
+                    configurations[name] = contents
+            return configurations
+
+    def execute(self, command_line):
+        """
+        Returns the exit code, stdout and stderr of a command
+        """
+        self.wait('command')
+        return self._execute(shlex.split(command_line))
+
+    def _execute(self, command):
+        # Commands are wrapped in timeout, which runs the command after its options and delay
+        if command[0] == 'timeout':
+            command = command[6:]
+        if command[0].endswith('sudo'):
+            command = command[1:]
+        program = command[0].split('/')[-1]
+
+        if program == 'find':
+            directories = command[1:command.index('-maxdepth')]
+            with self.lock:
+                lines = ['%s  %s' % (hashlib.md5(contents).hexdigest(), filename) for filename, contents in sorted(self.files.items()) if filename.rsplit('/', 1)[0] in directories]
+            return 0, ''.join('%s\n' % line for line in lines), ''
+        elif program == 'pg_lsclusters':
+            with self.lock:
+                lines = ['%s %s %d %s postgres /var/lib/postgresql/%s/%s /var/log/postgresql.log' % (version, name, port, online and 'online' or 'down', version, name) for version, name, port, online in sorted(self.clusters.values())]
+            return 0, ''.join('%s\n' % line for line in lines), ''
+        elif program == 'pg_createcluster':
+            # Creating a cluster is much slower than a round trip
+            time.sleep(self.fleet.cluster_latency)
+            version, name = command[-2:]
+            with self.lock:
+                if name in self.clusters:
+                    return 1, '', 'Error: cluster configuration already exists\n'
+                self.clusters[name] = (version, name, int(command[command.index('-p') + 1]), True)
+            return 0, '', ''
+        elif program == 'pg_ctlcluster':
+            version, name, action = command[-3:]
+            with self.lock:
+                if name not in self.clusters:
+                    return 1, '', 'Error: specified cluster does not exist\n'
+                self.clusters[name] = self.clusters[name][:3] + (action != 'stop',)
+            return 0, '', ''
+        elif program == 'pg_dropcluster':
+            with self.lock:
+                self.clusters.pop(command[-1], None)
+            return 0, '', ''
+        elif program == 'apache2ctl':
+            return 0, '', 'Syntax OK\n'
+        elif program == 'sh':
+            if 'nproc' in command[-1]:
+                return 0, '4\n0.50 0.40 0.30 1/100 1000\nMemTotal: 8000000 kB\nMemAvailable: 4000000 kB\n', ''
+            # Scripts are sequences of commands, executed in the same round trip
+            stdout = ''
+            for part in command[-1].split('; '):
+                exit_code, part_stdout, part_stderr = self._execute(shlex.split(part))
+                stdout += part_stdout
+            return exit_code, stdout, ''
+        elif program == 'date':
+            return 0, '%d\n' % time.time(), ''
+        elif program == 'echo':
+            return 0, '%s\n' % ' '.join(command[1:]), ''
+        elif program in ('service', 'mkdir', 'mv', 'rm', 'chmod', 'chgrp', 'true', 'ps', 'du', 'stat'):
+            return 0, '', ''
+
+        return 127, '', '%s: command not found\n' % program
+
+
+class FakeChannel(object):
+    """
+    SSH session channel running a single command
+    """
+    def __init__(self, server):
+        self.server = server
+        self.exit_code = None
+        self.stdout = ''
+        self.stderr = ''
+
+    def exec_command(self, command_line):
+        self.exit_code, self.stdout, self.stderr = self.server.execute(command_line)
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        data, self.stdout = self.stdout[:size], self.stdout[size:]
+        return data
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        data, self.stderr = self.stderr[:size], self.stderr[size:]
+        return data
+
+    def exit_status_ready(self):
+        return self.exit_code is not None
+
+    def recv_exit_status(self):
+        return self.exit_code
+
+    def close(self):
+        pass
+
+
+class FakeTransport(object):
+    def __init__(self, server):
+        self.server = server
+
+    def is_active(self):
+        return True
+
+    def send_ignore(self):
+        pass
+
+    def open_session(self):
+        return FakeChannel(self.server)
+
+    def open_channel(self, kind, destination, source):
+        # Every process is listening as soon as it is started
+        self.server.wait('port_check')
+        return FakeChannel(self.server)
+
+
+class FakeSSHClient(object):
+    def __init__(self, server):
+        self.transport = FakeTransport(server)
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        pass
+
+
+class FakeFile(StringIO):
+    """
+    SFTP file, stored on the fake server when closed
+    """
+    def __init__(self, server, filename):
+        StringIO.__init__(self)
+        self.server = server
+        self.filename = filename
+
+    def close(self):
+        if not self.closed:
+            self.server.wait('sftp')
+            with self.server.lock:
+                self.server.files[self.filename] = self.getvalue()
+        StringIO.close(self)
+
+
+class FakeSFTP(object):
+    def __init__(self, server):
+        self.server = server
+
+    def open(self, filename, mode='r'):
+        self.server.wait('sftp')
+        return FakeFile(self.server, filename)
+
+    def posix_rename(self, old_filename, new_filename):
+        self.server.wait('sftp')
+        with self.server.lock:
+            self.server.files[new_filename] = self.server.files.pop(old_filename)
+
+    def remove(self, filename):
+        self.server.wait('sftp')
+        with self.server.lock:
+            self.server.files.pop(filename, None)
+
+    def close(self):
+        pass
+
+
+class FakeSupervisorNamespace(object):
+    def __init__(self, server, methods):
+        self.server = server
+        self.methods = methods
+
+    def __getattr__(self, name):
+        method = self.methods[name]
+
+        def call(*args):
+            self.server.wait('supervisor')
+            return method(*args)
+        return call
+
+
+class FakeSupervisor(object):
+    """
+    Supervisor XML-RPC client of a fake server
+    """
+    def __init__(self, server):
+        self.server = server
+        self.supervisor = FakeSupervisorNamespace(server, {
+            'reloadConfig': self.reloadConfig,
+            'getAllProcessInfo': self.getAllProcessInfo,
+        })
+        self.system = FakeSupervisorNamespace(server, {
+            'multicall': self.multicall,
+        })
+
+    def reloadConfig(self):
+        configurations = self.server.program_configurations()
+        with self.server.lock:
+            added = sorted(set(configurations) - set(self.server.programs))
+            removed = sorted(set(self.server.programs) - set(configurations))
+            changed = sorted(name for name in set(configurations) & set(self.server.programs) if configurations[name] != self.server.programs[name])
+            self.server.programs = configurations
+        return [[added, changed, removed]]
+
+    def getAllProcessInfo(self):
+        with self.server.lock:
+            return [{
+                'name': name,
+                'group': name,
+                'pid': name in self.server.running and 1000 or 0,
+                'statename': name in self.server.running and 'RUNNING' or 'STOPPED',
+                'start': int(self.server.running.get(name, 0)),
+                'now': int(time.time()),
+            } for name in sorted(self.server.programs)]
+
+    def _call(self, method_name, parameters):
+        name = parameters[0]
+        with self.server.lock:
+            if method_name == 'supervisor.addProcessGroup':
+                self.server.running[name] = time.time()
+                return True
+            elif method_name == 'supervisor.stopProcessGroup':
+                self.server.running.pop(name, None)
+                return [{'name': name, 'group': name, 'status': 80, 'description': 'OK'}]
+            elif method_name == 'supervisor.startProcessGroup':
+                self.server.running.setdefault(name, time.time())
+                return [{'name': name, 'group': name, 'status': 80, 'description': 'OK'}]
+            elif method_name == 'supervisor.removeProcessGroup':
+                return True
+        return {'faultCode': 1, 'faultString': 'UNKNOWN_METHOD'}
+
+    def multicall(self, calls):
+        return [self._call(call['methodName'], call['params']) for call in calls]
+
+
+class FakeSSHConnection(object):
+    """
+    Replaces connection_pool.SSHConnection
+    """
+    fleet = None
+
+    def __init__(self, params, name=None):
+        self.params = params
+        server = self.fleet.server(params['address'])
+        server.wait('ssh_connect', self.fleet.connect_latency)
+        self.client = FakeSSHClient(server)
+        self.sftp = FakeSFTP(server)
+        self.last_used = time.time()
+
+    def is_alive(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class FakeXMLRPCLib(object):
+    """
+    Replaces the xmlrpclib module in connection_pool
+    """
+    def __init__(self, fleet):
+        self.fleet = fleet
+
+    def ServerProxy(self, url):
+        return FakeSupervisor(self.fleet.server(urlparse.urlparse(url).hostname))
+
+
+class FakeFleet(object):
+    """
+    Fake servers, keyed by address
+    Installing the fleet patches the connection pool, so every remote server of the module is one of its fake servers
+    @param latency : Duration of a round trip, in seconds
+    @param connect_latency : Duration of an SSH connection, in seconds
+    @param cluster_latency : Duration of the creation of a PostgreSQL cluster, in seconds
+    """
+    def __init__(self, latency=0.002, connect_latency=0.05, cluster_latency=0.1):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.cluster_latency = cluster_latency
+        self.counters = Counters()
+        self.servers = {}
+        self._lock = threading.Lock()
+        self._patched = []
+
+    def server(self, address):
+        with self._lock:
+            if address not in self.servers:
+                self.servers[address] = FakeServer(self, address)
+            return self.servers[address]
+
+    def _patch(self, module, name, value):
+        self._patched.append((module, name, getattr(module, name)))
+        setattr(module, name, value)
+
+    def install(self, connection_pool):
+        """
+        Patch the connection_pool module of the hosting module
+        """
+        connection_pool.ssh_pool.close()
+        connection_pool.supervisor_clients.close()
+        FakeSSHConnection.fleet = self
+        self._patch(connection_pool, 'SSHConnection', FakeSSHConnection)
+        self._patch(connection_pool, 'xmlrpclib', FakeXMLRPCLib(self))
+
+    def uninstall(self):
+        while self._patched:
+            module, name, value = self._patched.pop()
+            setattr(module, name, value)
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    hosting module for OpenERP, Allow to very simply create and manage new OpenERP instances
+#    Copyright (C) 2014 SYLEAM Info Services (<http://www.Syleam.fr/>)
+#              Sylvain Garancher <sylvain.garancher@syleam.fr>
+#
+#    This file is a part of hosting
+#
+#    hosting is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    hosting is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Benchmark of the hosting module against a fleet of fake servers
+
+Runs in a database where the hosting module is installed, the changes are rolled back at the end of each size
+Only the traces of the operations, stored in their own transactions, are kept :
+    python benchmarks/run.py -c /etc/openerp/openerp-server.conf -d hosting_bench --sizes 10,100,1000
+"""
+
+import sys
+import time
+import json
+import logging
+import optparse
+import resource
+
+SCENARIOS = ['create', 'update_unchanged', 'server_write', 'template_change']
+
+
+class QueryCounter(object):
+    """
+    Counts the queries executed through a cursor
+    """
+    def __init__(self, cr):
+        self.count = 0
+        execute = cr.execute
+
+        def counting_execute(*args, **kwargs):
+            self.count += 1
+            return execute(*args, **kwargs)
+        cr.execute = counting_execute
+
+    def reset(self):
+        count, self.count = self.count, 0
+        return count
+
+
+def peak_memory():
+    """
+    Returns the peak resident memory of the process, in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def setup(pool, cr, uid, server_count, options):
+    """
+    Create the fake servers and their variants
+    Returns the lists of server ids and variant ids
+    """
+    server_obj = pool.get('hosting.server')
+    variant_obj = pool.get('hosting.variant')
+    model, version_id = pool.get('ir.model.data').get_object_reference(cr, uid, 'hosting', 'hosting_version_70')
+    version = pool.get('hosting.version').read(cr, uid, version_id, ['oerp_template', 'supervisor_template', 'apache_template'])
+
+    server_ids = []
+    variant_ids = []
+    for index in range(server_count):
+        address = 'bench-server-%d' % index
+        server_id = server_obj.create(cr, uid, {
+            'name': address,
+            'local': False,
+            'ssh_address': address,
+            'ssh_password': 'bench',
+            'supervisor_address': address,
+            'supervisor_password': 'bench',
+            'prefix': 'bench%d_' % index,
+            'restart_batch_size': options.restart_batch_size,
+            'pg_pool_size': 0,
+        })
+        server_ids.append(server_id)
+        variant_ids.append(variant_obj.create(cr, uid, {
+            'name': 'bench-%d' % index,
+            'server_id': server_id,
+            'version_id': version_id,
+            'oerp_template': version['oerp_template'],
+            'supervisor_template': version['supervisor_template'],
+            'apache_template': version['apache_template'],
+        }))
+
+    return server_ids, variant_ids
+
+
+def run_size(pool, cr, uid, size, fleet, options):
+    """
+    Run all scenarios for a fleet of size instances
+    Returns the list of measures
+    """
+    instance_obj = pool.get('hosting.instance')
+    server_obj = pool.get('hosting.server')
+    variant_obj = pool.get('hosting.variant')
+    context = {'hosting_synchronous': True, 'hosting_max_workers': options.max_workers}
+
+    server_ids, variant_ids = setup(pool, cr, uid, min(options.servers, size), options)
+    queries = QueryCounter(cr)
+    instance_ids = []
+
+    def create():
+        values_list = [{'variant_id': variant_ids[index % len(variant_ids)]} for index in range(size)]
+        if options.bulk:
+            instance_ids.extend(instance_obj.create_many(cr, uid, values_list, context=context))
+        else:
+            for values in values_list:
+                instance_ids.append(instance_obj.create(cr, uid, values, context=context))
+
+    def update_unchanged():
+        instance_obj.update_configuration_files(cr, uid, instance_ids, context=context)
+
+    def server_write():
+        server_obj.write(cr, uid, server_ids, {'domain_name': 'bench-%d.example.com' % size}, context=context)
+
+    def template_change():
+        for variant in variant_obj.read(cr, uid, variant_ids, ['apache_template']):
+            variant_obj.write(cr, uid, [variant['id']], {'apache_template': variant['apache_template'] + '\n# Changed by the benchmark\n'}, context=context)
+
+    functions = {
+        'create': create,
+        'update_unchanged': update_unchanged,
+        'server_write': server_write,
+        'template_change': template_change,
+    }
+    measures = []
+    for scenario in options.scenarios:
+        fleet.counters.reset()
+        queries.reset()
+        start = time.time()
+        functions[scenario]()
+        duration = time.time() - start
+        round_trips = fleet.counters.reset()
+        measures.append({
+            'size': size,
+            'scenario': scenario,
+            'duration': duration,
+            'per_instance': duration / size,
+            'round_trips': sum(round_trips.values()),
+            'round_trips_detail': round_trips,
+            'queries': queries.reset(),
+            'peak_memory': peak_memory(),
+        })
+        print_measure(measures[-1])
+
+    return measures
+
+
+def print_measure(measure):
+    print '%(size)8d  %(scenario)-18s %(duration)10.2fs %(per_instance)10.4fs %(round_trips)12d %(queries)10d %(peak_memory)10.1fMB' % measure
+    sys.stdout.flush()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog -c CONFIG -d DATABASE [options]')
+    parser.add_option('-c', '--config', dest='config', help='OpenERP server configuration file')
+    parser.add_option('-d', '--database', dest='database', help='Database where the hosting module is installed')
+    parser.add_option('--sizes', dest='sizes', default='10,100,1000,10000', help='Comma separated numbers of instances [default: %default]')
+    parser.add_option('--servers', dest='servers', type='int', default=4, help='Number of fake servers [default: %default]')
+    parser.add_option('--scenarios', dest='scenarios', default=','.join(SCENARIOS), help='Comma separated scenarios, among %s [default: %%default]' % ', '.join(SCENARIOS))
+    parser.add_option('--latency', dest='latency', type='float', default=0.002, help='Duration of a round trip to a server, in seconds [default: %default]')
+    parser.add_option('--connect-latency', dest='connect_latency', type='float', default=0.05, help='Duration of an SSH connection, in seconds [default: %default]')
+    parser.add_option('--cluster-latency', dest='cluster_latency', type='float', default=0.1, help='Duration of the creation of a PostgreSQL cluster, in seconds [default: %default]')
+    parser.add_option('--max-workers', dest='max_workers', type='int', default=8, help='Number of servers processed simultaneously [default: %default]')
+    parser.add_option('--restart-batch-size', dest='restart_batch_size', type='int', default=5, help='Restart batch size of the fake servers [default: %default]')
+    parser.add_option('--bulk', dest='bulk', action='store_true', default=False, help='Create all instances with a single create_many call')
+    parser.add_option('--json', dest='json', help='Write the measures in this JSON file')
+    options, args = parser.parse_args()
+    if not options.database:
+        parser.error('The database is required')
+    options.scenarios = [scenario for scenario in options.scenarios.split(',') if scenario]
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('Unknown scenarios : %s' % ', '.join(sorted(unknown)))
+
+    # The hosting module can only be imported once the addons path is known
+    import openerp
+    openerp.tools.config.parse_config(options.config and ['-c', options.config] or [])
+    logging.getLogger('hosting').setLevel(logging.WARNING)
+    from openerp import pooler
+    from openerp import SUPERUSER_ID
+    from openerp.addons.hosting import connection_pool
+    from openerp.addons.hosting.benchmarks.fakes import FakeFleet
+
+    db, pool = pooler.get_db_and_pool(options.database)
+    fleet = FakeFleet(latency=options.latency, connect_latency=options.connect_latency, cluster_latency=options.cluster_latency)
+    fleet.install(connection_pool)
+
+    print '%8s  %-18s %11s %11s %12s %10s %12s' % ('size', 'scenario', 'wall time', 'per inst.', 'round trips', 'queries', 'peak memory')
+    measures = []
+    try:
+        for size in [int(size) for size in options.sizes.split(',')]:
+            fleet.servers.clear()
+            cr = db.cursor()
+            try:
+                measures.extend(run_size(pool, cr, SUPERUSER_ID, size, fleet, options))
+            finally:
+                cr.rollback()
+                cr.close()
+    finally:
+        fleet.uninstall()
+
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(measures, json_file, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    hosting module for OpenERP, Allow to very simply create and manage new OpenERP instances
+#    Copyright (C) 2014 SYLEAM Info Services (<http://www.Syleam.fr/>)
+#              Sylvain Garancher <sylvain.garancher@syleam.fr>
+#
+#    This file is a part of hosting
+#
+#    hosting is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    hosting is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import time
+import socket
+import xmlrpclib
+import threading
+import paramiko
+import instrumentation
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+logger = logging.getLogger('hosting')
+
+# Delay in seconds after which an SSH connection attempt fails
+CONNECT_TIMEOUT = 30
+
+# Errors meaning that the SSH transport is not usable anymore
+CONNECTION_ERRORS = (socket.error, EOFError, paramiko.SSHException)
+
+
+class SSHConnection(object):
+    """
+    Authenticated SSH connection, with its SFTP channel opened on first use
+    @param name : Name of the server, used in the timing spans
+    """
+    def __init__(self, params, name=None):
+        self.params = params
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        with instrumentation.span('ssh_connect', name or params['address']):
+            self.client.connect(params['address'], port=params['port'], username=params['username'], password=params['password'], timeout=CONNECT_TIMEOUT)
+        self._sftp = None
+        self.last_used = time.time()
+
+    @property
+    def sftp(self):
+        if self._sftp is None:
+            self._sftp = self.client.open_sftp()
+        return self._sftp
+
+    def is_alive(self):
+        """
+        Check that the transport is still active and answers
+        """
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+
+        try:
+            transport.send_ignore()
+        except CONNECTION_ERRORS:
+            return False
+
+        return True
+
+    def close(self):
+        try:
+            if self._sftp is not None:
+                self._sftp.close()
+            self.client.close()
+        except CONNECTION_ERRORS:
+            pass
+
+
+class SSHConnectionPool(object):
+    """
+    Keeps authenticated SSH connections alive, per server id
+    """
+    def __init__(self, max_size=4, idle_timeout=300):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # Idle connections, per server id
+        self._idle = defaultdict(list)
+        # Connection parameters used for the pooled connections, per server id
+        self._params = {}
+        # Semaphores limiting the number of open connections, per server id
+        self._semaphores = {}
+
+    def _get_semaphore(self, server_id, max_size):
+        with self._lock:
+            size, semaphore = self._semaphores.get(server_id, (None, None))
+            if size != max_size:
+                semaphore = threading.BoundedSemaphore(max_size)
+                self._semaphores[server_id] = (max_size, semaphore)
+
+        return semaphore
+
+    def _reap(self, idle_timeout):
+        """
+        Close connections unused since more than idle_timeout seconds
+        Must be called with the lock held
+        """
+        expired = []
+        limit = time.time() - idle_timeout
+        for server_id, connections in self._idle.items():
+            expired.extend(connection for connection in connections if connection.last_used < limit)
+            connections[:] = [connection for connection in connections if connection.last_used >= limit]
+
+        return expired
+
+    def _acquire(self, server_id, params, idle_timeout, name=None):
+        with self._lock:
+            expired = self._reap(idle_timeout)
+
+            # Connection parameters changed, drop the old connections
+            if self._params.get(server_id) != params:
+                expired.extend(self._idle.pop(server_id, []))
+                self._params[server_id] = params
+
+            candidates = self._idle[server_id]
+            self._idle[server_id] = []
+
+        for connection in expired:
+            connection.close()
+
+        # Use the most recently used connection which is still alive
+        connection = None
+        while candidates:
+            candidate = candidates.pop()
+            if connection is None and candidate.is_alive():
+                connection = candidate
+            else:
+                candidate.close()
+
+        if connection is None:
+            logger.debug('Open a new SSH connection to %s' % params['address'])
+            connection = SSHConnection(params, name=name)
+
+        return connection
+
+    def _release(self, server_id, connection):
+        connection.last_used = time.time()
+        with self._lock:
+            if self._params.get(server_id) == connection.params:
+                self._idle[server_id].append(connection)
+                return
+
+        # Parameters changed while the connection was in use
+        connection.close()
+
+    @contextmanager
+    def connection(self, server_id, params, max_size=None, idle_timeout=None, name=None):
+        """
+        Yields a pooled SSHConnection for the server
+        @param params : Dict containing the address, port, username and password used to connect
+        @param name : Name of the server, used in the timing spans
+        """
+        semaphore = self._get_semaphore(server_id, max_size or self.max_size)
+        semaphore.acquire()
+        try:
+            connection = self._acquire(server_id, params, idle_timeout or self.idle_timeout, name=name)
+            try:
+                yield connection
+            except CONNECTION_ERRORS:
+                # Broken connection, don't give it back to the pool
+                connection.close()
+                raise
+            except:
+                self._release(server_id, connection)
+                raise
+            else:
+                self._release(server_id, connection)
+        finally:
+            semaphore.release()
+
+    def close(self, server_id=None):
+        """
+        Close idle connections of a server, or of all servers
+        """
+        with self._lock:
+            if server_id is None:
+                connections = [connection for connections in self._idle.values() for connection in connections]
+                self._idle.clear()
+                self._params.clear()
+            else:
+                connections = self._idle.pop(server_id, [])
+                self._params.pop(server_id, None)
+
+        for connection in connections:
+            connection.close()
+
+
+class SupervisorClientCache(object):
+    """
+    Keeps one Supervisor XML-RPC client per server id
+    The HTTP connection of a client is kept alive between calls, so a client is used by one thread at a time
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Tuples of (url, client, lock), per server id
+        self._clients = {}
+
+    @contextmanager
+    def client(self, server_id, url):
+        with self._lock:
+            entry = self._clients.get(server_id)
+            if entry is None or entry[0] != url:
+                entry = (url, xmlrpclib.ServerProxy(url), threading.Lock())
+                self._clients[server_id] = entry
+
+        url, client, lock = entry
+        with lock:
+            try:
+                yield client
+            except socket.error:
+                # Broken connection, the next call will use a new client
+                self.close(server_id)
+                raise
+
+    def close(self, server_id=None):
+        with self._lock:
+            if server_id is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(server_id, None)
+
+
+ssh_pool = SSHConnectionPool()
+supervisor_clients = SupervisorClientCache()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
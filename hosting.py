@@ -22,43 +22,146 @@
 #
 ##############################################################################
 
+import os
+import json
 import getpass
-import xmlrpclib
-import subprocess
-import paramiko
+import binascii
+import functools
+import threading
+import traceback
+from datetime import datetime, timedelta
 from collections import defaultdict
 from contextlib import contextmanager
+from openerp import pooler
 from openerp.osv import orm
 from openerp.osv import fields
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+from connection_pool import ssh_pool
+import remote
+import templates
+import instrumentation
 import logging
 logger = logging.getLogger('hosting')
 
 
-@contextmanager
-def closing(fileobject):
+def _stored_fields(model):
     """
-    Decorated function used to automatically close paramiko sftp fileobjects
+    Returns the names of the fields of the model which can be read in a single query
     """
-    try:
-        yield fileobject
-    finally:
-        fileobject.close()
+    return [name for name, column in model._columns.items() if column._type not in ('one2many', 'many2many') and not isinstance(column, fields.function)]
+
+
+def _traced(operation):
+    """
+    Decorator recording the timing spans of a method in a hosting.trace
+    When called from an already traced operation, the method is only a span of this operation
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, cr, uid, *args, **kwargs):
+            if instrumentation.current_trace() is not None:
+                with instrumentation.span(operation):
+                    return method(self, cr, uid, *args, **kwargs)
+
+            trace = instrumentation.Trace('%s %s' % (self._name, operation))
+            try:
+                with instrumentation.activate(trace):
+                    return method(self, cr, uid, *args, **kwargs)
+            finally:
+                # Operations which had nothing to do on the servers are not worth a trace
+                trace.close()
+                if trace.has_remote_spans():
+                    self.pool.get('hosting.trace').store(cr.dbname, uid, trace)
+        return wrapper
+    return decorator
+
+
+PROVISIONING_STATES = [
+    ('queued', 'Queued'),
+    ('provisioning', 'Provisioning'),
+    ('ready', 'Ready'),
+    ('failed', 'Failed'),
+]
+
+POSTGRESQL_MODES = [
+    ('cluster', 'One cluster per instance'),
+    ('shared', 'Shared cluster'),
+]
+
+BACKUP_STATES = [
+    ('queued', 'Queued'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+]
+
+PGBOUNCER_POOL_MODES = [
+    ('session', 'Session'),
+    ('transaction', 'Transaction'),
+]
+
 
 class HostingInstance(orm.Model):
     _name = 'hosting.instance'
     _description = 'Hosting Instance'
 
+    def _compute_instance_values(self, instance, server, ports):
+        """
+        Computes the values derived from the instance and its server
+        @param ports : Dict of the ports allocated to the instance, keyed by kind
+        """
+        instance_name = server['prefix'] + str(instance['id'])
+        values = {
+            'name': instance_name,
+            'oerp_port': ports.get('oerp', server['oerp_start_port'] + instance['id']),
+            'postgresql_port': ports.get('postgresql', server['postgresql_start_port'] + instance['id']),
+            'username': instance_name,
+            'filestore_path': '%s/%s' % (server['filestores_path'], instance_name),
+            'cluster_name': instance.get('cluster_name') or instance_name,
+            'access_log': '%s/%s.log' % (server['apache_log_path'], instance_name),
+        }
+
+        # Instances of the shared cluster connect through pgbouncer
+        if instance.get('postgresql_mode') == 'shared':
+            values.update(postgresql_port=server['pgbouncer_port'], cluster_name=server['shared_cluster_name'])
+
+        return values
+
+    def _get_instance_data(self, cr, uid, ids, context=None):
+        """
+        Returns a dict of the instances data, with their variant and server, keyed by instance id
+        Everything is read with one query per model, and the derived values are computed in memory
+        """
+        variant_obj = self.pool.get('hosting.variant')
+        server_obj = self.pool.get('hosting.server')
+
+        instances = self.read(cr, uid, ids, _stored_fields(self), context=context, load='_classic_write')
+        variants = dict((variant['id'], variant) for variant in variant_obj.read(cr, uid, list(set(instance['variant_id'] for instance in instances)), _stored_fields(variant_obj), context=context, load='_classic_write'))
+        servers = dict((server['id'], server) for server in server_obj.read(cr, uid, list(set(variant['server_id'] for variant in variants.values())), _stored_fields(server_obj), context=context, load='_classic_write'))
+
+        for variant in variants.values():
+            variant.update(variant_obj._compute_variant_values(variant, servers[variant['server_id']]))
+
+        # Allocated ports, instances created before the port allocator use their legacy ports
+        ports = defaultdict(dict)
+        if ids:
+            cr.execute('SELECT instance_id, kind, port FROM hosting_port WHERE instance_id IN %s', (tuple(ids),))
+            for instance_id, kind, port in cr.fetchall():
+                ports[instance_id][kind] = port
+
+        result = {}
+        for instance in instances:
+            variant = variants[instance['variant_id']]
+            server = servers[variant['server_id']]
+            instance.update(self._compute_instance_values(instance, server, ports[instance['id']]))
+            instance.update(variant=variant, server=server)
+            result[instance['id']] = instance
+
+        return result
+
     def _get_instance_values(self, cr, uid, ids, field_name, args, context=None):
         result = {}
-        for instance in self.browse(cr, uid, ids, context=context):
-            instance_name = instance.variant_id.server_id.prefix + str(instance.id)
-            result[instance.id] = {
-                'name': instance_name,
-                'oerp_port': instance.variant_id.server_id.oerp_start_port + instance.id,
-                'postgresql_port': instance.variant_id.server_id.postgresql_start_port + instance.id,
-                'username': instance_name,
-                'filestore_path': '%s/%s' % (instance.variant_id.server_id.filestores_path, instance_name),
-            }
+        for instance_id, instance in self._get_instance_data(cr, uid, ids, context=context).items():
+            result[instance_id] = dict((name, instance[name]) for name in ('name', 'oerp_port', 'postgresql_port', 'username', 'filestore_path'))
 
         return result
 
@@ -70,93 +173,643 @@ class HostingInstance(orm.Model):
         'postgresql_port': fields.function(_get_instance_values, method=True, string='PostgreSQL Port', type='integer', store=False, multi='values', help='Port used for PostgreSQL by this instance'),
         'username': fields.function(_get_instance_values, method=True, string='Username', type='char', store=False, size=64, multi='values', help='Username linked to this instance'),
         'filestore_path': fields.function(_get_instance_values, method=True, string='Filestore Path', type='char', store=False, size=512, multi='values', help='Path of the filestore for this instance'),
+        'file_ids': fields.one2many('hosting.instance.file', 'instance_id', 'Deployed Files', readonly=True, help='Configuration files last deployed for this instance'),
+        'provisioning_state': fields.selection(PROVISIONING_STATES, 'Provisioning State', required=True, readonly=True, help='State of the creation of the instance on its server'),
+        'suspended': fields.boolean('Suspended', readonly=True, help='Checked when the OpenERP process and the PostgreSQL cluster of the instance are stopped'),
+        'sleeping': fields.boolean('Sleeping', readonly=True, help='Checked when the OpenERP process was stopped because the instance was idle, it starts again on the next request'),
+        'last_activity': fields.datetime('Last Activity', readonly=True, help='Date of the last request received by the instance, or of the start of its process'),
+        'cluster_name': fields.char('PostgreSQL Cluster', size=64, readonly=True, help='Name of the PostgreSQL cluster taken from the pool of the server, the cluster is named as the instance if empty'),
+        'postgresql_mode': fields.selection(POSTGRESQL_MODES, 'PostgreSQL Mode', required=True, readonly=True, help='The database of the instance is in its own PostgreSQL cluster, or in the shared cluster of its server behind pgbouncer'),
+        'db_password': fields.char('Database Password', size=64, readonly=True, help='Password of the PostgreSQL role of the instance in the shared cluster'),
+        'process_state': fields.char('Process State', size=16, readonly=True, help='State of the Supervisor process of the instance, at the last metrics collection'),
+        'pg_alive': fields.boolean('PostgreSQL Online', readonly=True, help='Checked if the PostgreSQL cluster of the instance was online at the last metrics collection'),
+        'memory_rss': fields.float('Memory (MB)', readonly=True, help='Resident memory of the OpenERP process, at the last metrics collection'),
+        'cpu_percent': fields.float('CPU (%)', readonly=True, help='Processor usage of the OpenERP process, between the last two metrics collections'),
+        'cpu_pid': fields.integer('CPU Sample Process', readonly=True, help='PID of the OpenERP process at the last metrics collection'),
+        'cpu_time': fields.float('CPU Sample Time', readonly=True, help='Processor time in seconds used by the OpenERP process since its start, at the last metrics collection'),
+        'cpu_uptime': fields.float('CPU Sample Uptime', readonly=True, help='Uptime in seconds of the server, at the last metrics collection'),
+        'disk_usage': fields.float('Filestore Size (MB)', readonly=True, help='Disk space used by the filestore, at the last measure'),
+        'metrics_date': fields.datetime('Metrics Date', readonly=True, help='Date of the last metrics collection'),
+        'metric_ids': fields.one2many('hosting.metric', 'instance_id', 'Metrics', readonly=True, help='History of the metrics of the instance'),
+        'backup_ids': fields.one2many('hosting.backup', 'instance_id', 'Backups', readonly=True, help='Backups of the databases and filestore of the instance'),
+        'config_dirty': fields.boolean('Configuration Outdated', readonly=True, help='Checked when the configuration files of this instance are waiting for an update'),
+    }
+
+    _defaults = {
+        'provisioning_state': 'ready',
+        'config_dirty': False,
+        'suspended': False,
+        'postgresql_mode': 'cluster',
     }
 
     def create(self, cr, uid, values, context=None):
-        id = super(HostingInstance, self).create(cr, uid, values, context=context)
-        instance = self.browse(cr, uid, id, context=context)
+        return self.create_many(cr, uid, [values], context=context)[0]
 
-        # Create PostgreSQL cluster
-        logger.info('%s - Create PostgreSQL Cluster' % instance.name)
-        instance.variant_id.server_id.create_pg_cluster(instance.postgresql_port, instance.name)
+    def create_many(self, cr, uid, values_list, context=None):
+        """
+        Create several instances, and provision them together
+        Clusters are created in parallel, and each server reloads its services once for all its new instances
+        Returns the list of created ids
+        """
+        if context is None:
+            context = {}
 
-        # Update configuration files
-        self.update_configuration_files(cr, uid, [id], context=context)
+        cluster_obj = self.pool.get('hosting.pg.cluster')
+        server_obj = self.pool.get('hosting.server')
 
-        return id
+        ids = []
+        claimed_ids = []
+        for values in values_list:
+            # Place the instance on the least loaded server providing the requested version
+            values = dict(values, provisioning_state='queued')
+            version_id = values.pop('version_id', False)
+            if not values.get('variant_id') and version_id:
+                values['variant_id'] = server_obj.choose_variant(cr, uid, version_id, context=context)
+
+            # The PostgreSQL mode of the server is kept by the instance, changing it only applies to new instances
+            server_id = self.pool.get('hosting.variant').read(cr, uid, values['variant_id'], ['server_id'], context=context, load='_classic_write')['server_id']
+            values['postgresql_mode'] = server_obj.read(cr, uid, server_id, ['postgresql_mode'], context=context)['postgresql_mode']
+            if values['postgresql_mode'] == 'shared':
+                values['db_password'] = binascii.hexlify(os.urandom(16))
+
+            id = super(HostingInstance, self).create(cr, uid, values, context=context)
+            ids.append(id)
+
+            # Take a ready to use PostgreSQL cluster from the server pool
+            if values['postgresql_mode'] == 'cluster' and cluster_obj.claim(cr, uid, server_id, id, context=context):
+                claimed_ids.append(id)
+
+        self.allocate_ports(cr, uid, ids, context=context)
+
+        # The caller provisions the instances itself
+        if context.get('hosting_defer_provision'):
+            return ids
+
+        # Provision the instances now, or let the job runner do it
+        # With a cluster from the pool, only the configuration files have to be written
+        if context.get('hosting_synchronous'):
+            self.provision(cr, uid, ids, context=context)
+            return ids
+        if claimed_ids:
+            self.provision(cr, uid, claimed_ids, context=context)
+
+        server_instances = defaultdict(list)
+        for instance in self.browse(cr, uid, [id for id in ids if id not in claimed_ids], context=context):
+            server_instances[instance.variant_id.server_id].append(instance)
+        for server, instances in server_instances.items():
+            self.pool.get('hosting.job').create(cr, uid, {
+                'name': len(instances) == 1 and 'Provision %s' % instances[0].name or 'Provision %d instances on %s' % (len(instances), server.name),
+                'job_type': 'provision',
+                'server_id': server.id,
+                'instance_id': len(instances) == 1 and instances[0].id or False,
+                'instance_ids': [(6, 0, [instance.id for instance in instances])],
+            }, context=context)
+
+        return ids
 
     def write(self, cr, uid, ids, values, context=None):
         res = super(HostingInstance, self).write(cr, uid, ids, values, context=context)
 
+        # Instances may have moved to another server
+        if 'variant_id' in values:
+            self.allocate_ports(cr, uid, ids, context=context)
+
         # Update configuration files
         self.update_configuration_files(cr, uid, ids, context=context)
 
         return res
 
+    def allocate_ports(self, cr, uid, ids, context=None):
+        """
+        Allocate the OpenERP and PostgreSQL ports of the instances on their server
+        Ports allocated on another server are released, instances of the shared cluster have no PostgreSQL port
+        """
+        port_obj = self.pool.get('hosting.port')
+        for instance in self.browse(cr, uid, ids, context=context):
+            server_id = instance.variant_id.server_id.id
+            cr.execute('UPDATE hosting_port SET instance_id = NULL WHERE instance_id = %s AND server_id != %s', (instance.id, server_id))
+            for kind in instance.postgresql_mode == 'shared' and ('oerp',) or ('oerp', 'postgresql'):
+                port_obj.allocate(cr, uid, server_id, kind, instance.id, context=context)
+
+        return True
+
+    def mark_dirty(self, cr, uid, ids, context=None):
+        """
+        Schedule an update of the configuration files of the instances
+        Updates requested for a server within its update delay are merged in a single update
+        """
+        if context is None:
+            context = {}
+
+        if not ids:
+            return True
+
+        if context.get('hosting_synchronous'):
+            return self.update_configuration_files(cr, uid, ids, context=context)
+
+        job_obj = self.pool.get('hosting.job')
+
+        cr.execute('UPDATE hosting_instance SET config_dirty = True WHERE id IN %s', (tuple(ids),))
+        cr.execute("""
+            SELECT DISTINCT server.id, server.name, server.update_delay
+            FROM hosting_instance instance
+                JOIN hosting_variant variant ON variant.id = instance.variant_id
+                JOIN hosting_server server ON server.id = variant.server_id
+            WHERE instance.id IN %s""", (tuple(ids),))
+        for server_id, server_name, update_delay in cr.fetchall():
+            job_obj.enqueue_unique(cr, uid, 'update', server_id, 'Update %s' % server_name, delay=update_delay, context=context)
+
+        return True
+
+    def _set_provisioning_state(self, cr, uid, ids, state, context=None):
+        """
+        Change the provisioning state without updating the configuration files
+        """
+        return super(HostingInstance, self).write(cr, uid, ids, {'provisioning_state': state}, context=context)
+
+    @_traced('provision')
+    def provision(self, cr, uid, ids, context=None):
+        """
+        Create the PostgreSQL clusters and the configuration files of the instances
+        """
+        self._set_provisioning_state(cr, uid, ids, 'provisioning', context=context)
+
+        def create_databases(params, instances):
+            # Create PostgreSQL clusters, clusters taken from the pool of the server already exist
+            remote.create_pg_clusters(params, [(instance['postgresql_port'], instance['cluster_name']) for instance in instances if instance['postgresql_mode'] != 'shared' and instance['cluster_name'] == instance['name']])
+
+            # Instances of the shared cluster only need a role, they create their databases themselves
+            shared_instances = [instance for instance in instances if instance['postgresql_mode'] == 'shared']
+            if shared_instances:
+                remote.create_pg_clusters(params, [(params['shared_cluster_port'], params['shared_cluster_name'])])
+                remote.create_pg_roles(params, [(instance['username'], instance['db_password']) for instance in shared_instances])
+        self._run_on_servers(cr, uid, ids, create_databases, context=context)
+
+        # Update configuration files
+        self.update_configuration_files(cr, uid, ids, context=context)
+
+        self._set_provisioning_state(cr, uid, ids, 'ready', context=context)
+
+        return True
+
+    @_traced('suspend')
+    def suspend(self, cr, uid, ids, context=None):
+        """
+        Stop the OpenERP processes and the PostgreSQL clusters of the instances, to free the resources of idle instances
+        """
+        ids = self.search(cr, uid, [('id', 'in', ids), ('suspended', '=', False)], context=context)
+        if not ids:
+            return True
+
+        # Removing the Supervisor programs stops the processes, with a single reload per server
+        super(HostingInstance, self).write(cr, uid, ids, {'suspended': True}, context=context)
+        self.update_configuration_files(cr, uid, ids, context=context)
+        self._run_on_servers(cr, uid, ids, lambda params, instances: remote.control_pg_clusters(params, 'stop', [instance['cluster_name'] for instance in instances if instance['postgresql_mode'] != 'shared']), context=context)
+
+        return True
+
+    @_traced('resume')
+    def resume(self, cr, uid, ids, context=None):
+        """
+        Start the PostgreSQL clusters and the OpenERP processes of suspended instances
+        """
+        ids = self.search(cr, uid, [('id', 'in', ids), ('suspended', '=', True)], context=context)
+        if not ids:
+            return True
+
+        self._run_on_servers(cr, uid, ids, lambda params, instances: remote.control_pg_clusters(params, 'start', [instance['cluster_name'] for instance in instances if instance['postgresql_mode'] != 'shared']), context=context)
+        super(HostingInstance, self).write(cr, uid, ids, {'suspended': False}, context=context)
+        self.update_configuration_files(cr, uid, ids, context=context)
+
+        return True
+
+    @_traced('unlink')
+    def unlink(self, cr, uid, ids, context=None):
+        """
+        Remove the configuration files, PostgreSQL clusters or databases and filestores of the instances, then delete them
+        """
+        if context is None:
+            context = {}
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+
+        # Removing the configuration files stops the processes and disables the vhosts, with a single reload per server
+        self.update_configuration_files(cr, uid, ids, context=dict(context, hosting_removed_ids=ids))
+
+        def remove(params, instances):
+            remote.control_pg_clusters(params, 'drop', [instance['cluster_name'] for instance in instances if instance['postgresql_mode'] != 'shared'])
+            remote.drop_pg_roles(params, [instance['username'] for instance in instances if instance['postgresql_mode'] == 'shared'])
+            remote.remove_filestores(params, [instance['filestore_path'] for instance in instances])
+        self._run_on_servers(cr, uid, ids, remove, context=context)
+
+        # Dropped clusters taken from a pool can't be used again
+        cluster_obj = self.pool.get('hosting.pg.cluster')
+        cluster_obj.unlink(cr, uid, cluster_obj.search(cr, uid, [('instance_id', 'in', ids)], context=context), context=context)
+
+        return super(HostingInstance, self).unlink(cr, uid, ids, context=context)
+
+    def _get_database_location(self, instance):
+        """
+        Returns a dict containing the port of the cluster holding the databases of the instance, the role owning them and the filestore path
+        The owner is None when the instance has its own cluster, all databases of the cluster belonging to it
+        @param instance : Dict of the instance data, as returned by _get_instance_data
+        """
+        if instance['postgresql_mode'] == 'shared':
+            return {'cluster_port': instance['server']['shared_cluster_port'], 'owner': instance['username'], 'filestore_path': instance['filestore_path']}
+
+        return {'cluster_port': instance['postgresql_port'], 'owner': None, 'filestore_path': instance['filestore_path']}
+
+    def _create_backups(self, cr, uid, ids, context=None):
+        """
+        Create the queued backups of the instances, without saving them
+        Returns the list of created backup ids
+        """
+        backup_obj = self.pool.get('hosting.backup')
+        now = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        return [backup_obj.create(cr, uid, {
+            'name': '%s %s' % (instance.name, now),
+            'instance_id': instance.id,
+            'instance_name': instance.name,
+            'variant_id': instance.variant_id.id,
+            'server_id': instance.variant_id.server_id.id,
+        }, context=context) for instance in self.browse(cr, uid, ids, context=context)]
+
+    def backup(self, cr, uid, ids, context=None):
+        """
+        Save the databases and the filestores of the instances, in the backups directory of their server
+        Returns the list of created backup ids
+        """
+        if context is None:
+            context = {}
+
+        backup_ids = self._create_backups(cr, uid, ids, context=context)
+        if context.get('hosting_synchronous'):
+            self.pool.get('hosting.backup').execute(cr, uid, backup_ids, context=context)
+            return backup_ids
+
+        for backup in self.pool.get('hosting.backup').browse(cr, uid, backup_ids, context=context):
+            self.pool.get('hosting.job').create(cr, uid, {
+                'name': 'Back up %s' % backup.instance_name,
+                'job_type': 'backup',
+                'server_id': backup.server_id.id,
+                'instance_id': backup.instance_id.id,
+                'backup_id': backup.id,
+            }, context=context)
+
+        return backup_ids
+
+    def clone(self, cr, uid, ids, context=None):
+        """
+        Create new instances containing a copy of the databases and filestores of the instances
+        The variant of the new instances, on the same server, can be given in the hosting_variant_id context key, defaults to the variant of each instance
+        Returns the list of created instance ids
+        """
+        return self.pool.get('hosting.backup').restore_to_new_instance(cr, uid, self._create_backups(cr, uid, ids, context=context), context=context)
+
+    def _run_on_servers(self, cr, uid, ids, function, context=None):
+        """
+        Call the function for each server hosting some of the instances, servers being processed in parallel
+        @param function : Function called with the server parameters and the list of data of its instances, as returned by _get_instance_data
+        Returns a dict of results, keyed by server id
+        """
+        if context is None:
+            context = {}
+
+        server_obj = self.pool.get('hosting.server')
+
+        servers = {}
+        server_instances = defaultdict(list)
+        for instance in self._get_instance_data(cr, uid, ids, context=context).values():
+            servers[instance['server']['id']] = server_obj._get_server_params(instance['server'])
+            server_instances[instance['server']['id']].append(instance)
+
+        results = remote.run_in_parallel(dict((server_id, lambda server_id=server_id: function(servers[server_id], server_instances[server_id])) for server_id in servers), max_workers=context.get('hosting_max_workers', remote.MAX_WORKERS))
+
+        errors = ['%s : %s' % (servers[server_id]['name'], exception) for server_id, (result, exception) in sorted(results.items()) if exception is not None]
+        if errors:
+            raise orm.except_orm('Error', '\n'.join(errors))
+
+        return dict((server_id, result) for server_id, (result, exception) in results.items())
+
+    def _get_config_values(self, cr, uid, instance, context=None):
+        """
+        Returns the values available in the configuration file templates of an instance
+        @param instance : Dict of the instance data, as returned by _get_instance_data
+        """
+        variant = instance['variant']
+        server = instance['server']
+
+        # Instances of the shared cluster use their own role, pgbouncer listens in the PostgreSQL sockets directory
+        db_user, db_password = server['system_username'], 'False'
+        if instance['postgresql_mode'] == 'shared':
+            db_user, db_password = instance['username'], instance['db_password']
+
+        return {
+            'root_path': variant['variant_path'],
+            'admin_passwd': 'admin',
+            'db_host': server['postgresql_pid_path'],
+            'db_port': instance['postgresql_port'],
+            'db_user': db_user,
+            'db_password': db_password,
+            'port': instance['oerp_port'],
+            'instance_name': instance['name'],
+            'system_username': server['system_username'],
+            'virtualenv_path': variant['virtualenv_path'],
+            'apache_port': server['apache_port'],
+            'dbname': cr.dbname,
+            'domain_name': server['domain_name'],
+            'access_log': instance['access_log'],
+            'wakeup_script': server['wakeup_script_path'],
+        }
+
+    @_traced('update_configuration_files')
     def update_configuration_files(self, cr, uid, ids, context=None):
         """
         Rewrite configuration files for each instance
         Then, restart instances and reload Apache configuration
+        Files whose contents match the last deployed ones are not sent to the server
+        Servers are processed in parallel, the files of each server are written in order
+        Returns a dict of update results, keyed by instance name
+        """
+        if context is None:
+            context = {}
+
+        server_obj = self.pool.get('hosting.server')
+        file_obj = self.pool.get('hosting.instance.file')
+
+        with instrumentation.span('load_data'):
+            # Hashes of the last deployed files
+            cache = {}
+            file_ids = file_obj.search(cr, uid, [('instance_id', 'in', ids)], context=context)
+            for deployed_file in file_obj.read(cr, uid, file_ids, ['instance_id', 'kind', 'filename', 'hash'], context=context, load='_classic_write'):
+                cache[deployed_file['instance_id'], deployed_file['kind']] = deployed_file
+
+            # Group the instances by variant, to render each template for all its instances at once
+            variant_instances = defaultdict(list)
+            for instance in self._get_instance_data(cr, uid, ids, context=context).values():
+                variant_instances[instance['variant_id']].append(instance)
+
+        # Check all templates before writing anything on the servers
+        template_errors = []
+        for instances in variant_instances.values():
+            variant = instances[0]['variant']
+            for template_name, text in [
+                ('instance_url_template', instances[0]['server']['instance_url_template']),
+                ('oerp_template', variant['oerp_template']),
+                ('supervisor_template', variant['supervisor_template']),
+                ('apache_template', variant['apache_template']),
+            ]:
+                error = templates.get_template(text).error
+                if error:
+                    template_errors.append('%s - %s : %s' % (variant['name'], template_name, error))
+        if template_errors:
+            raise orm.except_orm('Error', 'Invalid templates :\n%s' % '\n'.join(template_errors))
+
+        servers = {}
+        files = defaultdict(list)
+        ports = defaultdict(dict)
+        summary = {}
+        urls = []
+        # Instances without OpenERP process
+        stopped = set()
+        # Files which a failed attempt may have written without reloading the services, per server
+        unconfirmed = defaultdict(set)
+        removed_ids = context.get('hosting_removed_ids', [])
+        with instrumentation.span('render'):
+            for instances in variant_instances.values():
+                variant = instances[0]['variant']
+                server = instances[0]['server']
+                if server['id'] not in servers:
+                    servers[server['id']] = server_obj._get_server_params(server)
+
+                # Define the config values, and update the instance URLs
+                values_list = [self._get_config_values(cr, uid, instance, context=context) for instance in instances]
+                for instance, config_values, instance_url in zip(instances, values_list, templates.get_template(server['instance_url_template']).render_all(values_list)):
+                    summary[instance['name']] = {'changed': [], 'errors': []}
+                    ports[server['id']][instance['name']] = instance['oerp_port']
+                    config_values['instance_url'] = instance_url
+                    if instance_url != instance['url']:
+                        urls.extend([instance['id'], instance_url])
+
+                # Render the OpenERP, Supervisor and apache2 vhost configuration files
+                rendered_files = zip(
+                    templates.get_template(variant['oerp_template']).render_all(values_list),
+                    templates.get_template(variant['supervisor_template']).render_all(values_list),
+                    templates.get_template(variant['apache_template']).render_all(values_list),
+                )
+                for instance, (oerp_contents, supervisor_contents, apache_contents) in zip(instances, rendered_files):
+                    # Removed instances lose all their files, suspended instances only lose their Supervisor program
+                    if instance['id'] in removed_ids:
+                        oerp_contents = supervisor_contents = apache_contents = None
+                    elif instance['suspended']:
+                        supervisor_contents = None
+                    if supervisor_contents is None:
+                        stopped.add(instance['name'])
+
+                    for kind, filename, contents in [
+                        ('oerp', '%s/%s.conf' % (server['oerp_path'], instance['name']), oerp_contents),
+                        ('supervisor', '%s/%s.conf' % (server['supervisor_path'], instance['name']), supervisor_contents),
+                        ('apache', '%s/%s' % (server['apache_path'], instance['name']), apache_contents),
+                    ]:
+                        # Keep only the files which changed since the last deployment
+                        contents_hash = contents is not None and remote.content_hash(contents) or False
+                        deployed_file = cache.get((instance['id'], kind))
+                        if deployed_file and deployed_file['filename'] == filename and deployed_file['hash'] == contents_hash:
+                            continue
+                        files[server['id']].append((instance['id'], instance['name'], kind, filename, contents, contents_hash))
+
+                        # Files of ready instances without deployment record are only missing from the cache
+                        if deployed_file or instance['provisioning_state'] != 'ready':
+                            unconfirmed[server['id']].add(filename)
+
+            # pgbouncer configuration of the servers hosting instances in a shared cluster, when it changed since the last deployment
+            server_files = server_obj._get_pgbouncer_files(cr, uid, servers.keys(), removed_ids, context=context)
+
+        # Store all new URLs at once
+        if urls:
+            cr.execute('UPDATE hosting_instance SET url = data.url FROM (VALUES %s) AS data(id, url) WHERE hosting_instance.id = data.id' % ', '.join(['(%s, %s)'] * (len(urls) / 2)), urls)
+
+        def update_server(server_id):
+            """
+            Synchronize the files of a server, then reload its services
+            """
+            params = servers[server_id]
+            logger.info('%s - Update configuration files' % params['name'])
+            file_kinds = dict((filename, (instance_name, kind)) for instance_id, instance_name, kind, filename, contents, contents_hash in files[server_id])
+            server_contents = dict((filename, contents) for instance_id, instance_name, kind, filename, contents, contents_hash in files[server_id])
+            server_contents.update(server_files.get(server_id, {}))
+            try:
+                changed = remote.sync_configuration_files(params, server_contents)
+            except Exception, e:
+                for instance_name, kind in file_kinds.values():
+                    summary[instance_name]['errors'].append('%s : %s' % (kind, e))
+                raise
+
+            # Hashes are only stored once the services are reloaded, so files already written by a failed attempt
+            # still differ from the deployed ones, and their restarts and reloads are done again
+            # Files of ready instances missing from the cache and already identical on the server are only recorded
+            changed = sorted(set(changed) | unconfirmed[server_id] | set(server_files.get(server_id, {})))
+
+            force_restart = []
+            for filename in changed:
+                if filename not in file_kinds:
+                    continue
+                instance_name, kind = file_kinds[filename]
+                summary[instance_name]['changed'].append(kind)
+                if kind == 'oerp' and instance_name not in stopped:
+                    force_restart.append(instance_name)
+
+            # Nothing changed on the server, no need to reload anything
+            if not changed:
+                return
+
+            # Reload Supervisor configuration
+            logger.info('%s - Reload Supervisor configuration' % params['name'])
+            failures = remote.reload_supervisor_configuration(params, force_restart=force_restart, ports=ports[server_id])
+            for process_name, process_failures in failures.items():
+                if process_name in summary:
+                    summary[process_name]['errors'].extend(process_failures)
+
+            # Make pgbouncer read the new users list
+            if set(changed) & set(server_files.get(server_id, {})):
+                logger.info('%s - Reload pgbouncer configuration' % params['name'])
+                remote.reload_pgbouncer(params)
+
+            # Reload apache configuration, now or merged with the next requests
+            if 'apache' not in [file_kinds[filename][1] for filename in changed if filename in file_kinds]:
+                return None
+            if params['apache_reload_delay'] and not context.get('hosting_synchronous'):
+                return 'scheduled'
+            logger.info('%s - Reload Apache configuration' % params['name'])
+            reload_result = remote.reload_apache_configuration(params)
+            for filename in reload_result['disabled']:
+                if filename in file_kinds:
+                    summary[file_kinds[filename][0]]['errors'].append('apache : Configuration disabled, it breaks the apache configuration')
+            return reload_result
+
+        results = remote.run_in_parallel(dict((server_id, lambda server_id=server_id: update_server(server_id)) for server_id in set(files) | set(server_files)), max_workers=context.get('hosting_max_workers', remote.MAX_WORKERS))
+
+        with instrumentation.span('store_results'):
+            # Store the hashes of the files now present on the servers
+            deployed_files = []
+            errors = []
+            for server_id, (result, exception) in results.items():
+                if exception is not None:
+                    errors.append('%s : %s' % (servers[server_id]['name'], exception))
+                    continue
+
+                disabled = []
+                if result == 'scheduled':
+                    server_obj.schedule_apache_reload(cr, uid, [server_id], context=context)
+                elif result is not None:
+                    server_obj._store_apache_reload(cr, uid, server_id, result, context=context)
+                    disabled = result['disabled']
+                    if result['error']:
+                        errors.append('%s : Apache configuration test failed, apache was not reloaded\n%s' % (servers[server_id]['name'], result['error']))
+                deployed_files.extend((instance_id, kind, filename, contents_hash) for instance_id, instance_name, kind, filename, contents, contents_hash in files[server_id] if filename not in disabled)
+                if server_id in server_files:
+                    server_obj._store_pgbouncer_hash(cr, uid, server_id, server_files[server_id], context=context)
+            file_obj.store_hashes(cr, uid, deployed_files, context=context)
+
+        # Report the errors of the whole run at once
+        for instance_name, instance_summary in sorted(summary.items()):
+            errors.extend('%s - %s' % (instance_name, error) for error in instance_summary['errors'])
+        if errors:
+            raise orm.except_orm('Error', 'Some configuration updates failed :\n%s' % '\n'.join(errors))
+
+        return summary
+
+    def verify_configuration_files(self, cr, uid, ids, context=None):
+        """
+        Compare the last deployed files with the files present on the servers
+        Files modified or removed on the servers are marked as drifted, then deployed again
         """
         server_obj = self.pool.get('hosting.server')
+        file_obj = self.pool.get('hosting.instance.file')
+
+        # Group the deployed files by server
+        servers = {}
+        deployed_files = defaultdict(list)
+        file_ids = file_obj.search(cr, uid, [('instance_id', 'in', ids)], context=context)
+        for deployed_file in file_obj.browse(cr, uid, file_ids, context=context):
+            server = deployed_file.instance_id.variant_id.server_id
+            if server.id not in servers:
+                servers[server.id] = server_obj._get_server_params(server)
+            deployed_files[server.id].append(deployed_file)
+
+        hashes = remote.run_in_parallel(dict((server_id, lambda server_id=server_id: remote.get_file_hashes(servers[server_id], [deployed_file.filename for deployed_file in deployed_files[server_id]])) for server_id in servers))
+
+        for server_id, (server_hashes, exception) in hashes.items():
+            if exception is not None:
+                raise orm.except_orm('Error', 'Unable to read the configuration files of %s : %s' % (servers[server_id]['name'], exception))
+
+            # Repair the cache, the next update will deploy the drifted files again
+            for deployed_file in deployed_files[server_id]:
+                remote_hash = server_hashes.get(deployed_file.filename)
+                if (remote_hash or False) != deployed_file.hash:
+                    logger.warning('%s - Drift detected on %s' % (deployed_file.instance_id.name, deployed_file.filename))
+                    file_obj.write(cr, uid, [deployed_file.id], {'hash': remote_hash or False}, context=context)
 
-        server_ids = set()
-        force_restart = defaultdict(list)
-        for instance in self.browse(cr, uid, ids, context=context):
-            # Add server_id in list
-            server_ids.add(instance.variant_id.server_id.id)
-
-            # Define the config values
-            config_values = {
-                'root_path': instance.variant_id.variant_path,
-                'admin_passwd': 'admin',
-                'db_host': instance.variant_id.server_id.postgresql_pid_path,
-                'db_port': instance.postgresql_port,
-                'db_user': instance.variant_id.server_id.system_username,
-                'db_password': 'False',
-                'port': instance.oerp_port,
-                'instance_name': instance.name,
-                'system_username': instance.variant_id.server_id.system_username,
-                'virtualenv_path': instance.variant_id.virtualenv_path,
-                'apache_port': instance.variant_id.server_id.apache_port,
-                'dbname': cr.dbname,
-                'domain_name': instance.variant_id.server_id.domain_name,
-            }
+        self.update_configuration_files(cr, uid, ids, context=context)
 
-            # Update the instance URL
-            config_values['instance_url'] = instance.variant_id.server_id.instance_url_template % config_values
-            super(HostingInstance, self).write(cr, uid, [instance.id], {'url': config_values['instance_url']}, context=context)
-
-            # Create OpenERP configuration file
-            logger.info('%s - Update OpenERP configuration file' % instance.name)
-            oerp_filename = '%s/%s.conf' % (instance.variant_id.server_id.oerp_path, instance.name)
-            oerp_config = instance.variant_id.oerp_template % config_values
-            if instance.variant_id.server_id.write_configuration_file(oerp_filename, oerp_config):
-                force_restart[instance.variant_id.server_id.id].append(instance.name)
-
-            # Create Supervisor configuration file
-            logger.info('%s - Update Supervisor configuration file' % instance.name)
-            supervisor_filename = '%s/%s.conf' % (instance.variant_id.server_id.supervisor_path, instance.name)
-            supervisor_config = instance.variant_id.supervisor_template % config_values
-            instance.variant_id.server_id.write_configuration_file(supervisor_filename, supervisor_config)
-
-            # Create apache2 vhost file
-            logger.info('%s - Update Apache configuration file' % instance.name)
-            apache_filename = '%s/%s' % (instance.variant_id.server_id.apache_path, instance.name)
-            apache_config = instance.variant_id.apache_template % config_values
-            instance.variant_id.server_id.write_configuration_file(apache_filename, apache_config)
-
-        # Reload Supervisor configuration
-        logger.info('%s - Reload Supervisor configuration' % instance.variant_id.server_id.name)
-        server_obj.reload_supervisor_configuration(cr, uid, list(server_ids), force_restart=force_restart, context=context)
-
-        # Reload apache configuration
-        logger.info('%s - Reload Apache configuration' % instance.variant_id.server_id.name)
-        server_obj.reload_apache_configuration(cr, uid, list(server_ids), context=context)
+        return True
+
+
+class HostingInstanceFile(orm.Model):
+    _name = 'hosting.instance.file'
+    _description = 'Hosting Instance Deployed File'
+
+    _columns = {
+        'instance_id': fields.many2one('hosting.instance', 'Instance', required=True, ondelete='cascade', select=True, help='Instance using this file'),
+        'kind': fields.selection([('oerp', 'OpenERP'), ('supervisor', 'Supervisor'), ('apache', 'Apache')], 'Kind', required=True, help='Kind of configuration file'),
+        'filename': fields.char('Filename', size=512, required=True, help='Path of the file on the server'),
+        'hash': fields.char('Hash', size=32, help='MD5 hash of the last deployed contents'),
+    }
+
+    _sql_constraints = [
+        ('instance_kind_uniq', 'unique(instance_id, kind)', 'Only one file of each kind can be deployed per instance !'),
+    ]
+
+    def store_hashes(self, cr, uid, deployed_files, context=None):
+        """
+        Store the hashes of deployed files with two queries, whatever the number of files
+        @param deployed_files : List of (instance_id, kind, filename, hash) tuples
+        """
+        if not deployed_files:
+            return True
+
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(deployed_files))
+        parameters = [value for deployed_file in deployed_files for value in deployed_file]
+        cr.execute("""
+            UPDATE hosting_instance_file
+            SET filename = data.filename, hash = data.hash, write_uid = %%s, write_date = now() AT TIME ZONE 'UTC'
+            FROM (VALUES %s) AS data(instance_id, kind, filename, hash)
+            WHERE hosting_instance_file.instance_id = data.instance_id AND hosting_instance_file.kind = data.kind""" % values, [uid] + parameters)
+        cr.execute("""
+            INSERT INTO hosting_instance_file (instance_id, kind, filename, hash, create_uid, create_date, write_uid, write_date)
+            SELECT data.instance_id, data.kind, data.filename, data.hash, %%s, now() AT TIME ZONE 'UTC', %%s, now() AT TIME ZONE 'UTC'
+            FROM (VALUES %s) AS data(instance_id, kind, filename, hash)
+            WHERE NOT EXISTS (SELECT 1 FROM hosting_instance_file WHERE instance_id = data.instance_id AND kind = data.kind)""" % values, [uid, uid] + parameters)
 
         return True
 
 
+def _check_templates(template_fields):
+    """
+    Returns a constraint function checking the templates stored in the given fields
+    """
+    def check(self, cr, uid, ids, context=None):
+        for record in self.read(cr, uid, ids, template_fields, context=context):
+            for field_name in template_fields:
+                try:
+                    templates.check_template(record[field_name] or '')
+                except templates.TemplateError, e:
+                    raise orm.except_orm('Error', 'Invalid %s : %s' % (self._columns[field_name].string, e))
+        return True
+
+    return check
+
+
 class HostingVersion(orm.Model):
     _name = 'hosting.version'
     _description = 'Hosting Version'
@@ -168,18 +821,32 @@ class HostingVersion(orm.Model):
         'apache_template': fields.text('Apache Template', required=True, help='Apache Template configuration'),
     }
 
+    _constraints = [
+        (_check_templates(['oerp_template', 'supervisor_template', 'apache_template']), 'Invalid template', ['oerp_template', 'supervisor_template', 'apache_template']),
+    ]
+
 
 class HostingVariant(orm.Model):
     _name = 'hosting.variant'
     _description = 'Hosting Variant'
 
+    def _compute_variant_values(self, variant, server):
+        """
+        Computes the values derived from the variant and its server
+        """
+        return {
+            'variant_path': '%s/%s' % (server['variants_path'], variant['name']),
+            'virtualenv_path': '%s/%s' % (server['virtualenvs_path'], variant['name']),
+        }
+
     def _get_variant_values(self, cr, uid, ids, field_name, args, context=None):
+        server_obj = self.pool.get('hosting.server')
+        variants = self.read(cr, uid, ids, ['name', 'server_id'], context=context, load='_classic_write')
+        servers = dict((server['id'], server) for server in server_obj.read(cr, uid, list(set(variant['server_id'] for variant in variants)), ['variants_path', 'virtualenvs_path'], context=context))
+
         result = {}
-        for variant in self.browse(cr, uid, ids, context=context):
-            result[variant.id] = {
-                'variant_path': '%s/%s' % (variant.server_id.variants_path, variant.name),
-                'virtualenv_path': '%s/%s' % (variant.server_id.virtualenvs_path, variant.name),
-            }
+        for variant in variants:
+            result[variant['id']] = self._compute_variant_values(variant, servers[variant['server_id']])
 
         return result
 
@@ -195,6 +862,10 @@ class HostingVariant(orm.Model):
         'apache_template': fields.text('Apache Config File Template', required=True, help='Template for the configuration file of Apache'),
     }
 
+    _constraints = [
+        (_check_templates(['oerp_template', 'supervisor_template', 'apache_template']), 'Invalid template', ['oerp_template', 'supervisor_template', 'apache_template']),
+    ]
+
     def write(self, cr, uid, ids, values, context=None):
         res = super(HostingVariant, self).write(cr, uid, ids, values, context=context)
 
@@ -230,8 +901,9 @@ class HostingVariant(orm.Model):
         """
         Update all instances configuration files
         """
-        instance_ids = [instance.id for variant in self.browse(cr, uid, ids, context=context) for instance in variant.instance_ids]
-        self.pool.get('hosting.instance').update_configuration_files(cr, uid, instance_ids, context=context)
+        instance_obj = self.pool.get('hosting.instance')
+        instance_ids = instance_obj.search(cr, uid, [('variant_id', 'in', ids)], context=context)
+        instance_obj.mark_dirty(cr, uid, instance_ids, context=context)
 
         return True
 
@@ -247,9 +919,47 @@ class HostingServer(orm.Model):
         'ssh_username': fields.char('SSH Username', size=256, required=True, help='Remote hosting server username'),
         'ssh_password': fields.char('SSH Password', size=256, help='Remote hosting server password. If no password is supplied, the connection will require an SSH key (recommended)'),
         'ssh_port': fields.integer('SSH Port', required=True, help='Remote hosting server port'),
+        'ssh_pool_size': fields.integer('SSH Pool Size', required=True, help='Maximum number of simultaneous SSH connections to this server'),
+        'ssh_idle_timeout': fields.integer('SSH Idle Timeout', required=True, help='Delay in seconds after which an unused SSH connection is closed'),
+        'max_running_jobs': fields.integer('Maximum Running Jobs', required=True, help='Maximum number of jobs running simultaneously on this server'),
+        'command_timeout': fields.integer('Command Timeout', required=True, help='Delay in seconds after which a command executed on this server is interrupted'),
+        'apache_reload_delay': fields.integer('Apache Reload Delay', required=True, help='Delay in seconds during which the apache reload requests are merged (0 reloads apache immediately)'),
+        'apache_reload_date': fields.datetime('Last Apache Reload', readonly=True, help='Date of the last apache reload'),
+        'apache_reload_duration': fields.float('Last Apache Reload Duration', readonly=True, help='Duration in seconds of the last apache configuration test and reload'),
+        'apache_reload_error': fields.text('Last Apache Reload Error', readonly=True, help='Error of the last apache reload, and vhosts disabled because they broke the configuration'),
+        'restart_batch_size': fields.integer('Restart Batch Size', required=True, help='Number of instances restarted simultaneously on this server, the next ones are restarted when they answer on their port (0 restarts all instances at once)'),
+        'restart_timeout': fields.integer('Restart Timeout', required=True, help='Delay in seconds to wait for a restarted instance to answer before restarting the next ones'),
+        'update_delay': fields.integer('Update Delay', required=True, help='Delay in seconds during which the changes on this server, its variants and instances are merged before updating the configuration files'),
         'apache_port': fields.integer('Apache Port', required=True, help='Port used on apache for https'),
         'oerp_start_port': fields.integer('OpenERP Start Port', required=True, help='First port used for instances on this server'),
         'postgresql_start_port': fields.integer('PostgreSQL Start Port', required=True, help='First port used for instance clusters on this server'),
+        'port_range_size': fields.integer('Port Range Size', required=True, help='Number of ports available for OpenERP, and for PostgreSQL, from their start ports'),
+        'port_ids': fields.one2many('hosting.port', 'server_id', 'Ports', readonly=True, help='Ports allocated on this server'),
+        'pg_cluster_ids': fields.one2many('hosting.pg.cluster', 'server_id', 'PostgreSQL Clusters', readonly=True, help='PostgreSQL clusters created in the pool of this server'),
+        'idle_timeout': fields.integer('Idle Timeout', required=True, help='Delay in minutes without request after which an instance is stopped, until its next request (0 keeps the instances running)'),
+        'apache_log_path': fields.char('Apache Logs Path', size=512, required=True, help='Directory where Apache writes the access logs of the instances'),
+        'wakeup_script_path': fields.char('Wake-up Script Path', size=512, required=True, help='Path of the CGI script which starts the sleeping instances, called by Apache'),
+        'apache_group': fields.char('Apache Group', size=64, required=True, help='Group of the Apache processes, the only one allowed to read the wake-up script, which contains the Supervisor credentials'),
+        'pg_pool_size': fields.integer('PostgreSQL Pool Size', required=True, help='Number of started PostgreSQL clusters kept ready for the next instances (0 to create clusters on demand)'),
+        'postgresql_mode': fields.selection(POSTGRESQL_MODES, 'PostgreSQL Mode', required=True, help='Databases of the new instances are created in their own PostgreSQL cluster, or in the shared cluster of the server behind pgbouncer. Existing instances keep their mode'),
+        'shared_cluster_name': fields.char('Shared Cluster Name', size=64, required=True, help='Name of the PostgreSQL cluster shared by the instances in shared mode'),
+        'shared_cluster_port': fields.integer('Shared Cluster Port', required=True, help='Port of the PostgreSQL cluster shared by the instances in shared mode, only pgbouncer connects to it'),
+        'pgbouncer_port': fields.integer('pgbouncer Port', required=True, help='Port used by the instances in shared mode to connect to pgbouncer'),
+        'pgbouncer_path': fields.char('pgbouncer Path', size=512, required=True, help='Directory where pgbouncer configuration files will be stored'),
+        'pgbouncer_pool_mode': fields.selection(PGBOUNCER_POOL_MODES, 'pgbouncer Pool Mode', required=True, help='Moment when a server connection is given back to the pool : when the client disconnects, or at the end of each transaction'),
+        'pgbouncer_pool_size': fields.integer('pgbouncer Pool Size', required=True, help='Number of PostgreSQL connections opened by pgbouncer for each instance database'),
+        'pgbouncer_max_client_conn': fields.integer('pgbouncer Maximum Client Connections', required=True, help='Maximum number of connections accepted by pgbouncer, for all instances'),
+        'pgbouncer_hash': fields.char('pgbouncer Configuration Hash', size=32, readonly=True, help='Hash of the last deployed pgbouncer configuration files'),
+        'backups_path': fields.char('Backups Path', size=512, required=True, help='Directory where the backups of the instances will be stored'),
+        'backup_timeout': fields.integer('Backup Timeout', required=True, help='Delay in seconds after which a backup or a restore is interrupted'),
+        'max_running_backups': fields.integer('Maximum Running Backups', required=True, help='Maximum number of backups and restores running simultaneously on this server'),
+        'disk_usage_interval': fields.integer('Disk Usage Interval', required=True, help='Delay in minutes between two measures of the filestore sizes, which read all their files'),
+        'disk_usage_date': fields.datetime('Last Disk Usage Measure', readonly=True, help='Date of the last measure of the filestore sizes'),
+        'max_instances': fields.integer('Maximum Instances', help='Maximum number of instances hosted on this server (0 for no limit)'),
+        'cpu_count': fields.integer('CPU Count', readonly=True, help='Number of processors of this server, as last reported'),
+        'load_average': fields.float('Load Average', readonly=True, help='Load average over the last 5 minutes, as last reported'),
+        'memory_total': fields.integer('Total Memory', readonly=True, help='Total memory in MB, as last reported'),
+        'memory_available': fields.integer('Available Memory', readonly=True, help='Available memory in MB, as last reported'),
         'system_username': fields.char('System Username', size=64, required=True, help='User who will run the OpenERP instances'),
         'prefix': fields.char('Prefix', size=16, required=True, help='Prefix used for the instance specific names on this server'),
         'domain_name': fields.char('Domain Name', size=64, required=True, help='Domain name used to access instances on this server'),
@@ -273,6 +983,14 @@ class HostingServer(orm.Model):
         'local': True,
         'ssh_address': 'localhost',
         'ssh_port': 22,
+        'ssh_pool_size': 4,
+        'ssh_idle_timeout': 300,
+        'max_running_jobs': 2,
+        'update_delay': 30,
+        'command_timeout': 600,
+        'apache_reload_delay': 0,
+        'restart_batch_size': 5,
+        'restart_timeout': 120,
         'ssh_username': getpass.getuser(),
         'apache_port': 443,
         'supervisor_address': 'localhost',
@@ -280,6 +998,25 @@ class HostingServer(orm.Model):
         'supervisor_port': 9001,
         'oerp_start_port': 10000,
         'postgresql_start_port': 20000,
+        'port_range_size': 10000,
+        'disk_usage_interval': 360,
+        'max_instances': 0,
+        'pg_pool_size': 0,
+        'postgresql_mode': 'cluster',
+        'shared_cluster_name': 'hosting',
+        'shared_cluster_port': 5440,
+        'pgbouncer_port': 6432,
+        'pgbouncer_path': '/srv/openerp/hosting/conf/pgbouncer',
+        'pgbouncer_pool_mode': 'transaction',
+        'pgbouncer_pool_size': 20,
+        'pgbouncer_max_client_conn': 1000,
+        'backups_path': '/srv/openerp/hosting/backups',
+        'backup_timeout': 3600,
+        'max_running_backups': 1,
+        'idle_timeout': 0,
+        'apache_log_path': '/var/log/apache2',
+        'wakeup_script_path': '/srv/openerp/hosting/cgi-bin/hosting-wakeup',
+        'apache_group': 'www-data',
         'system_username': getpass.getuser(),
         'prefix': lambda self, cr, uid, context=None: cr.dbname,
         'domain_name': 'example.com',
@@ -294,48 +1031,130 @@ class HostingServer(orm.Model):
         'apache_path': '/srv/openerp/hosting/conf/apache2',
     }
 
+    _constraints = [
+        (_check_templates(['instance_url_template']), 'Invalid template', ['instance_url_template']),
+    ]
+
+    def create(self, cr, uid, values, context=None):
+        id = super(HostingServer, self).create(cr, uid, values, context=context)
+
+        # Fill the PostgreSQL cluster pool
+        if values.get('pg_pool_size'):
+            self.refill_pg_pool(cr, uid, [id], context=context)
+
+        return id
+
     def write(self, cr, uid, ids, values, context=None):
         res = super(HostingServer, self).write(cr, uid, ids, values, context=context)
 
+        # Drop pooled connections opened with the old parameters
+        if set(values) & set(['ssh_address', 'ssh_port', 'ssh_username', 'ssh_password']):
+            for server_id in ids:
+                ssh_pool.close(server_id)
+
+        # Fill the PostgreSQL cluster pools
+        if values.get('pg_pool_size'):
+            self.refill_pg_pool(cr, uid, ids, context=context)
+
         # Update all variants
         self.update_variants(cr, uid, ids, context=context)
 
         return res
 
-    def open_ssh_connection(self, cr, uid, ids, context=None):
+    def _get_server_params(self, server):
+        """
+        Returns the parameters used to work on the server, without needing the database
+        @param server : Browse record or dict of the values of the server
+        """
+        return {
+            'id': server['id'],
+            'name': server['name'],
+            'local': server['local'],
+            'ssh': {
+                'address': server['ssh_address'],
+                'port': server['ssh_port'],
+                'username': server['ssh_username'],
+                'password': server['ssh_password'] or None,
+            },
+            'ssh_pool_size': server['ssh_pool_size'],
+            'ssh_idle_timeout': server['ssh_idle_timeout'],
+            'restart_batch_size': server['restart_batch_size'],
+            'apache_path': server['apache_path'],
+            'command_timeout': server['command_timeout'],
+            'apache_reload_delay': server['apache_reload_delay'],
+            'restart_timeout': server['restart_timeout'],
+            'postgresql_version': server['postgresql_version'],
+            'postgresql_pid_path': server['postgresql_pid_path'],
+            'system_username': server['system_username'],
+            'filestores_path': server['filestores_path'],
+            'wakeup_script_path': server['wakeup_script_path'],
+            'apache_group': server['apache_group'],
+            'shared_cluster_name': server['shared_cluster_name'],
+            'shared_cluster_port': server['shared_cluster_port'],
+            'pgbouncer_path': server['pgbouncer_path'],
+            'pgbouncer_port': server['pgbouncer_port'],
+            'pgbouncer_pool_mode': server['pgbouncer_pool_mode'],
+            'pgbouncer_pool_size': server['pgbouncer_pool_size'],
+            'pgbouncer_max_client_conn': server['pgbouncer_max_client_conn'],
+            'supervisor_path': server['supervisor_path'],
+            'prefix': server['prefix'],
+            'backups_path': server['backups_path'],
+            'backup_timeout': server['backup_timeout'],
+            'supervisor_url': 'http://%s:%s@%s:%d/RPC2' % (
+                server['supervisor_username'],
+                server['supervisor_password'],
+                server['supervisor_address'],
+                server['supervisor_port'],
+            ),
+        }
+
+    @contextmanager
+    def ssh_connection(self, cr, uid, ids, context=None):
         """
-        Returns a SSHClient instance
+        Yields a pooled SSH connection, kept alive for the next calls
         """
         # Check that we call this method on a single id only
-        assert len(ids) == 1, 'The write_configuration_file method must be called on a single id'
+        assert len(ids) == 1, 'The ssh_connection method must be called on a single id'
 
         server = self.browse(cr, uid, ids[0], context=context)
-        ssh_connection = paramiko.SSHClient()
-        ssh_connection.load_system_host_keys()
-        ssh_connection.connect(server.ssh_address, port=server.ssh_port, username=server.ssh_username, password=server.ssh_password)
+        with remote.ssh_connection(self._get_server_params(server)) as connection:
+            yield connection
 
-        return ssh_connection
-
-    def execute_command(self, cr, uid, ids, command, context=None):
+    @_traced('execute_command')
+    def execute_command(self, cr, uid, ids, command, timeout=None, context=None):
         """
         Execute a command on the server, locally or remotely
+        The output is logged line by line while the command runs
+        @param timeout : Maximum duration of the command in seconds, defaults to the command timeout of the server
+        Returns a dict containing the exit code, outputs and duration of the command
         """
         # Check that we call this method on a single id only
-        assert len(ids) == 1, 'The write_configuration_file method must be called on a single id'
+        assert len(ids) == 1, 'The execute_command method must be called on a single id'
 
         server = self.browse(cr, uid, ids[0], context=context)
-        if server.local:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            for line in stdout.split('\n'):
-                logger.info(line.strip())
-        else:
-            ssh_connection = server.open_ssh_connection()
-            stdin, stdout, stderr = ssh_connection.exec_command(' '.join(command))
-            for line in stdout.readlines():
-                logger.info(line.strip())
-            ssh_connection.close()
+        try:
+            result = remote.execute_command(self._get_server_params(server), command, timeout=timeout)
+        except remote.CommandError, e:
+            raise orm.except_orm('Error', '%s : %s' % (server.name, e))
 
+        return result.to_dict()
+
+    def execute_commands(self, cr, uid, commands, context=None):
+        """
+        Execute commands on several servers simultaneously, the commands of a same server being executed in order
+        @param commands : Dict of lists of commands, keyed by server id
+        Returns a dict of lists of command results, keyed by server id
+        """
+        servers = dict((server.id, self._get_server_params(server)) for server in self.browse(cr, uid, commands.keys(), context=context))
+        results = remote.execute_commands(servers, commands)
+
+        errors = ['%s : %s' % (servers[server_id]['name'], exception) for server_id, (server_results, exception) in results.items() if exception is not None]
+        if errors:
+            raise orm.except_orm('Error', '\n'.join(errors))
+
+        return dict((server_id, [result.to_dict() for result in server_results]) for server_id, (server_results, exception) in results.items())
+
+    @_traced('write_configuration_file')
     def write_configuration_file(self, cr, uid, ids, filename, new_contents, context=None):
         """
         Writes contents in a configuration file
@@ -345,30 +1164,76 @@ class HostingServer(orm.Model):
         assert len(ids) == 1, 'The write_configuration_file method must be called on a single id'
 
         server = self.browse(cr, uid, ids[0], context=context)
-        openfile = open
+        return remote.write_configuration_file(self._get_server_params(server), filename, new_contents)
 
-        if not server.local:
-            ssh_connection = server.open_ssh_connection()
-            sftp_connection = ssh_connection.open_sftp()
-            openfile = sftp_connection.open
+    @_traced('sync_configuration_files')
+    def sync_configuration_files(self, cr, uid, ids, files, context=None):
+        """
+        Writes all configuration files of the server in a single batch
+        Only files whose contents changed are uploaded
+        @param files : Dict of file contents, keyed by filename
+        Returns the list of changed filenames
+        """
+        # Check that we call this method on a single id only
+        assert len(ids) == 1, 'The sync_configuration_files method must be called on a single id'
 
-        with closing(openfile(filename, 'a+')) as config_file:
-            old_contents = config_file.read()
+        server = self.browse(cr, uid, ids[0], context=context)
+        return remote.sync_configuration_files(self._get_server_params(server), files)
 
-        # Contents changed, rewrite the file
-        if old_contents != new_contents:
-            with closing(openfile(filename, 'w')) as config_file:
-                config_file.write(new_contents)
+    def verify_configuration_files(self, cr, uid, ids, context=None):
+        """
+        Compare the last deployed files of all instances of the servers with the files present on the servers
+        """
+        instance_obj = self.pool.get('hosting.instance')
+        instance_ids = instance_obj.search(cr, uid, [('variant_id.server_id', 'in', ids)], context=context)
+        return instance_obj.verify_configuration_files(cr, uid, instance_ids, context=context)
 
-            if not server.local:
-                ssh_connection.close()
-            return True
+    def _get_pgbouncer_files(self, cr, uid, ids, removed_instance_ids=None, context=None):
+        """
+        Returns the pgbouncer configuration files of the servers hosting instances in a shared cluster, keyed by server id
+        Servers whose files match the last deployed ones are left out, so they are not contacted
+        @param removed_instance_ids : Ids of the instances which must not be able to connect anymore
+        """
+        if not ids:
+            return {}
+        if removed_instance_ids is None:
+            removed_instance_ids = []
+
+        instance_obj = self.pool.get('hosting.instance')
 
-        # Contents didn't change
-        if not server.local:
-            ssh_connection.close()
-        return False
+        cr.execute("""
+            SELECT variant.server_id, instance.id, instance.db_password
+            FROM hosting_instance instance
+                JOIN hosting_variant variant ON variant.id = instance.variant_id
+            WHERE variant.server_id IN %s AND instance.postgresql_mode = 'shared'""", (tuple(ids),))
+        users = defaultdict(list)
+        for server_id, instance_id, db_password in cr.fetchall():
+            users[server_id].append((instance_id, db_password))
+
+        result = {}
+        for server in self.read(cr, uid, users.keys(), _stored_fields(self), context=context, load='_classic_write'):
+            files = remote.pgbouncer_files(self._get_server_params(server), [
+                (instance_obj._compute_instance_values({'id': instance_id, 'postgresql_mode': 'shared'}, server, {})['username'], db_password)
+                for instance_id, db_password in users[server['id']] if instance_id not in removed_instance_ids
+            ])
+            if self._pgbouncer_hash(files) != server['pgbouncer_hash']:
+                result[server['id']] = files
 
+        return result
+
+    def _pgbouncer_hash(self, files):
+        """
+        Returns a single hash of the names and contents of the pgbouncer configuration files
+        """
+        return remote.content_hash(''.join('%s\n%s\n' % (filename, files[filename]) for filename in sorted(files)))
+
+    def _store_pgbouncer_hash(self, cr, uid, server_id, files, context=None):
+        """
+        Store the hash of the deployed pgbouncer configuration files, without updating the instances
+        """
+        return super(HostingServer, self).write(cr, uid, [server_id], {'pgbouncer_hash': self._pgbouncer_hash(files)}, context=context)
+
+    @_traced('create_pg_cluster')
     def create_pg_cluster(self, cr, uid, ids, cluster_port, cluster_name, context=None):
         """
         Create new PostgreSQL clusters with the given name and port
@@ -377,17 +1242,17 @@ class HostingServer(orm.Model):
         assert len(ids) == 1, 'The create_pg_cluster method must be called on a single id'
 
         server = self.browse(cr, uid, ids[0], context=context)
-        server.execute_command([
-            '/usr/bin/sudo',
-            '/usr/bin/pg_createcluster',
-            '--start',
-            '-p', str(cluster_port),
-            '-s', server.postgresql_pid_path,
-            '-u', server.system_username,
-            server.postgresql_version,
-            cluster_name,
-        ])
 
+        # The cluster may have been created by a previous attempt
+        try:
+            if not remote.create_pg_clusters(self._get_server_params(server), [(cluster_port, cluster_name)]):
+                logger.info('%s - PostgreSQL cluster already exists' % cluster_name)
+        except remote.CommandError, e:
+            raise orm.except_orm('Error', '%s : %s' % (server.name, e))
+
+        return True
+
+    @_traced('reload_supervisor_configuration')
     def reload_supervisor_configuration(self, cr, uid, ids, force_restart=None, context=None):
         """
         Reload supervisor configuration, then stop old services and start new services
@@ -399,47 +1264,998 @@ class HostingServer(orm.Model):
             force_restart = {}
 
         for server in self.browse(cr, uid, ids, context=context):
-            # Connect to the supervisor server
-            supervisorServer = xmlrpclib.Server('http://%s:%s@%s:%d/RPC2' % (
-                server.supervisor_username,
-                server.supervisor_password,
-                server.supervisor_address,
-                server.supervisor_port,
-            ))
-
-            # Reload supervisor configuration
-            added, changed, removed = supervisorServer.supervisor.reloadConfig()[0]
-
-            # Stop changed and removed services
-            for process_name in set(changed + removed + force_restart.get(server.id, [])) - set(added):
-                supervisorServer.supervisor.stopProcessGroup(process_name)
-                supervisorServer.supervisor.removeProcessGroup(process_name)
-
-            # Start added and changed services
-            for process_name in set(added + changed + force_restart.get(server.id, [])) - set(removed):
-                supervisorServer.supervisor.addProcessGroup(process_name)
+            remote.reload_supervisor_configuration(self._get_server_params(server), force_restart=force_restart.get(server.id, []))
 
+    @_traced('reload_apache_configuration')
     def reload_apache_configuration(self, cr, uid, ids, context=None):
         """
-        Reload apache configuration
+        Check and reload apache configuration
+        The vhosts disabled because they broke the configuration are deployed again by the next update of their instance
         """
+        file_obj = self.pool.get('hosting.instance.file')
         for server in self.browse(cr, uid, ids, context=context):
-            server.execute_command([
-                '/usr/bin/sudo',
-                '/usr/sbin/service',
-                'apache2',
-                'reload',
-            ])
+            result = remote.reload_apache_configuration(self._get_server_params(server))
+
+            # Forget the hashes of the disabled vhosts, the updated files may have been deployed before this reload
+            instance_errors = []
+            if result['disabled']:
+                file_ids = file_obj.search(cr, uid, [('instance_id.variant_id.server_id', '=', server.id), ('kind', '=', 'apache'), ('filename', 'in', result['disabled'])], context=context)
+                file_obj.write(cr, uid, file_ids, {'hash': False}, context=context)
+                for deployed_file in file_obj.browse(cr, uid, file_ids, context=context):
+                    logger.error('%s - apache : Configuration disabled, it breaks the apache configuration' % deployed_file.instance_id.name)
+                    instance_errors.append('%s - apache : Configuration disabled, it breaks the apache configuration' % deployed_file.instance_id.name)
+
+            self._store_apache_reload(cr, uid, server.id, result, instance_errors=instance_errors, context=context)
+            if result['error']:
+                raise orm.except_orm('Error', '%s : Apache configuration test failed, apache was not reloaded\n%s' % (server.name, '\n'.join(instance_errors + [result['error']])))
+
+        return True
+
+    def schedule_apache_reload(self, cr, uid, ids, context=None):
+        """
+        Request an apache reload, merged with the other requests received during the reload delay of the server
+        """
+        job_obj = self.pool.get('hosting.job')
+        for server in self.browse(cr, uid, ids, context=context):
+            job_obj.enqueue_unique(cr, uid, 'apache_reload', server.id, 'Reload Apache on %s' % server.name, delay=server.apache_reload_delay, context=context)
 
         return True
 
+    def _store_apache_reload(self, cr, uid, server_id, result, instance_errors=None, context=None):
+        """
+        Store the result of an apache reload, without updating the instances
+        @param instance_errors : Errors of the instances whose vhost was disabled, stored instead of the disabled filenames
+        """
+        return super(HostingServer, self).write(cr, uid, [server_id], {
+            'apache_reload_date': datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+            'apache_reload_duration': result['duration'],
+            'apache_reload_error': result['error'] or '\n'.join(instance_errors or ['Disabled : %s' % filename for filename in result['disabled']]) or False,
+        }, context=context)
+
+    def refill_pg_pool(self, cr, uid, ids, context=None):
+        """
+        Schedule the creation of the missing clusters in the PostgreSQL pool of the servers
+        """
+        job_obj = self.pool.get('hosting.job')
+        for server in self.browse(cr, uid, ids, context=context):
+            if server.pg_pool_size:
+                job_obj.enqueue_unique(cr, uid, 'refill_pg_pool', server.id, 'Refill PostgreSQL pool of %s' % server.name, context=context)
+
+        return True
+
+    def refresh_load(self, cr, uid, ids=None, context=None):
+        """
+        Read the processors, load and memory of the servers, all servers if ids is None
+        """
+        if ids is None:
+            ids = self.search(cr, uid, [], context=context)
+
+        servers = dict((server.id, self._get_server_params(server)) for server in self.browse(cr, uid, ids, context=context))
+        command = ['/bin/sh', '-c', 'nproc; cat /proc/loadavg; grep -E "^(MemTotal|MemAvailable):" /proc/meminfo']
+        results = remote.execute_commands(servers, dict((server_id, [command]) for server_id in servers))
+        for server_id, (server_results, exception) in results.items():
+            if exception is not None:
+                logger.warning('%s - Unable to read the server load : %s' % (servers[server_id]['name'], exception))
+                continue
+
+            lines = server_results[0].stdout.splitlines()
+            memory = dict((line.split(':')[0], int(line.split()[1]) / 1024) for line in lines[2:])
+            super(HostingServer, self).write(cr, uid, [server_id], {
+                'cpu_count': int(lines[0]),
+                'load_average': float(lines[1].split()[1]),
+                'memory_total': memory.get('MemTotal', 0),
+                'memory_available': memory.get('MemAvailable', 0),
+            }, context=context)
+
+        return True
+
+    def collect_metrics(self, cr, uid, ids=None, context=None):
+        """
+        Read the state and resource usage of the instances of the servers, all servers if ids is None
+        Servers are processed in parallel, and the samples are stored with a fixed number of queries
+        """
+        if context is None:
+            context = {}
+        if ids is None:
+            ids = self.search(cr, uid, [], context=context)
+
+        instance_obj = self.pool.get('hosting.instance')
+        instance_ids = instance_obj.search(cr, uid, [('variant_id.server_id', 'in', ids), ('provisioning_state', '=', 'ready')], context=context)
+
+        now = datetime.now()
+        date = now.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+
+        servers = {}
+        disk_usage_server_ids = set()
+        instances = defaultdict(dict)
+        previous_samples = {}
+        for instance in instance_obj._get_instance_data(cr, uid, instance_ids, context=context).values():
+            server = instance['server']
+            servers[server['id']] = self._get_server_params(server)
+            # The filestores are measured less often than the processes
+            if not server['disk_usage_date'] or server['disk_usage_date'] <= (now - timedelta(minutes=server['disk_usage_interval'])).strftime(DEFAULT_SERVER_DATETIME_FORMAT):
+                disk_usage_server_ids.add(server['id'])
+            instances[server['id']][instance['name']] = {
+                'id': instance['id'],
+                'cluster_name': instance['cluster_name'],
+                'postgresql_version': server['postgresql_version'],
+                'filestore_path': instance['filestore_path'],
+            }
+            previous_samples[instance['id']] = (instance['cpu_pid'], instance['cpu_time'], instance['cpu_uptime'])
+
+        results = remote.run_in_parallel(dict((server_id, lambda server_id=server_id: remote.collect_metrics(servers[server_id], instances[server_id], disk_usage=server_id in disk_usage_server_ids)) for server_id in servers), max_workers=context.get('hosting_max_workers', remote.MAX_WORKERS))
+
+        samples = []
+        for server_id, (metrics, exception) in results.items():
+            if exception is not None:
+                logger.warning('%s - Unable to collect the metrics : %s' % (servers[server_id]['name'], exception))
+                disk_usage_server_ids.discard(server_id)
+                continue
+            for instance_name, values in metrics.items():
+                instance_id = instances[server_id][instance_name]['id']
+                # Processor usage since the previous collection, unknown when the process or the server restarted in between
+                cpu_pid, cpu_time, cpu_uptime = previous_samples[instance_id]
+                cpu_percent = None
+                if values['cpu_pid'] and values['cpu_pid'] == cpu_pid and values['cpu_uptime'] > cpu_uptime and values['cpu_time'] >= cpu_time:
+                    cpu_percent = (values['cpu_time'] - cpu_time) / (values['cpu_uptime'] - cpu_uptime) * 100
+                samples.append((instance_id, dict(values, cpu_percent=cpu_percent)))
+
+        if disk_usage_server_ids:
+            super(HostingServer, self).write(cr, uid, list(disk_usage_server_ids), {'disk_usage_date': date}, context=context)
+
+        return self.pool.get('hosting.metric').store(cr, uid, date, samples, context=context)
+
+    def deploy_wakeup_script(self, cr, uid, ids, context=None):
+        """
+        Write the wake-up script called by Apache for the sleeping instances
+        """
+        for server in self.browse(cr, uid, ids, context=context):
+            try:
+                remote.deploy_wakeup_script(self._get_server_params(server))
+            except remote.CommandError, e:
+                raise orm.except_orm('Error', '%s : %s' % (server.name, e))
+
+        return True
+
+    def sleep_idle_instances(self, cr, uid, ids=None, context=None):
+        """
+        Stop the instances idle since the idle timeout of their server, all servers if ids is None
+        Sleeping instances are started again by the wake-up script on their next request
+        Instances whose Apache template does not call the wake-up script are never stopped
+        """
+        if context is None:
+            context = {}
+        if ids is None:
+            ids = self.search(cr, uid, [('idle_timeout', '>', 0)], context=context)
+
+        instance_obj = self.pool.get('hosting.instance')
+        instance_ids = instance_obj.search(cr, uid, [('variant_id.server_id', 'in', ids), ('provisioning_state', '=', 'ready'), ('suspended', '=', False)], context=context)
+
+        servers = {}
+        access_logs = defaultdict(dict)
+        instance_ids_by_name = {}
+        for instance in instance_obj._get_instance_data(cr, uid, instance_ids, context=context).values():
+            server = instance['server']
+            if not server['idle_timeout']:
+                continue
+            # Without the wake-up script, nothing would start the instance again
+            if 'wakeup_script' not in templates.get_template(instance['variant']['apache_template']).placeholders:
+                continue
+            servers[server['id']] = dict(self._get_server_params(server), idle_timeout=server['idle_timeout'] * 60)
+            access_logs[server['id']][instance['name']] = instance['access_log']
+            instance_ids_by_name[instance['name']] = instance['id']
+
+        def sleep_server(server_id):
+            # The script must be there before the first instance stops
+            params = servers[server_id]
+            remote.deploy_wakeup_script(params)
+            return remote.sleep_idle_instances(params, access_logs[server_id], params['idle_timeout'])
+
+        results = remote.run_in_parallel(dict((server_id, lambda server_id=server_id: sleep_server(server_id)) for server_id in servers), max_workers=context.get('hosting_max_workers', remote.MAX_WORKERS))
+
+        states = []
+        for server_id, (result, exception) in results.items():
+            if exception is not None:
+                logger.warning('%s - Unable to stop the idle instances : %s' % (servers[server_id]['name'], exception))
+                continue
+            for instance_name, state in result.items():
+                states.extend([instance_ids_by_name[instance_name], datetime.fromtimestamp(state['last_activity']).strftime(DEFAULT_SERVER_DATETIME_FORMAT), state['sleeping']])
+
+        if states:
+            cr.execute('UPDATE hosting_instance SET last_activity = data.last_activity::timestamp, sleeping = data.sleeping FROM (VALUES %s) AS data(id, last_activity, sleeping) WHERE hosting_instance.id = data.id' % ', '.join(['(%s, %s, %s)'] * (len(states) / 3)), states)
+
+        return True
+
+    def choose_variant(self, cr, uid, version_id, context=None):
+        """
+        Returns the variant of the version placed on the least loaded server
+        The load of a server is the sum of its used instance capacity, used memory and load per processor
+        """
+        variant_obj = self.pool.get('hosting.variant')
+        variant_ids = variant_obj.search(cr, uid, [('version_id', '=', version_id)], context=context)
+        if not variant_ids:
+            raise orm.except_orm('Error', 'No variant available for this version')
+
+        variants = variant_obj.read(cr, uid, variant_ids, ['server_id'], context=context, load='_classic_write')
+        server_ids = list(set(variant['server_id'] for variant in variants))
+        cr.execute("""
+            SELECT variant.server_id, count(instance.id)
+            FROM hosting_instance instance
+                JOIN hosting_variant variant ON variant.id = instance.variant_id
+            WHERE variant.server_id IN %s
+            GROUP BY variant.server_id""", (tuple(server_ids),))
+        instance_counts = dict(cr.fetchall())
+
+        scores = {}
+        for server in self.read(cr, uid, server_ids, ['max_instances', 'cpu_count', 'load_average', 'memory_total', 'memory_available'], context=context):
+            instance_count = instance_counts.get(server['id'], 0)
+            if server['max_instances'] and instance_count >= server['max_instances']:
+                continue
+            score = 0.0
+            if server['max_instances']:
+                score += float(instance_count) / server['max_instances']
+            if server['memory_total']:
+                score += 1.0 - float(server['memory_available']) / server['memory_total']
+            if server['cpu_count']:
+                score += server['load_average'] / server['cpu_count']
+            # Without any capacity information, fill the server hosting the less instances
+            scores[server['id']] = (score, instance_count)
+
+        if not scores:
+            raise orm.except_orm('Error', 'All servers providing this version are full')
+
+        server_id = min(scores, key=scores.get)
+        return [variant['id'] for variant in variants if variant['server_id'] == server_id][0]
+
     def update_variants(self, cr, uid, ids, context=None):
         """
         Update all variants data
         """
-        variant_ids = [variant.id for server in self.browse(cr, uid, ids, context=context) for variant in server.variant_ids]
-        self.pool.get('hosting.variant').update_instances(cr, uid, variant_ids, context=context)
+        variant_obj = self.pool.get('hosting.variant')
+        variant_ids = variant_obj.search(cr, uid, [('server_id', 'in', ids)], context=context)
+        variant_obj.update_instances(cr, uid, variant_ids, context=context)
+
+        return True
+
+
+class HostingPort(orm.Model):
+    _name = 'hosting.port'
+    _description = 'Hosting Port'
+    _order = 'server_id, kind, port'
+
+    _columns = {
+        'server_id': fields.many2one('hosting.server', 'Server', required=True, ondelete='cascade', select=True, help='Server on which this port is allocated'),
+        'kind': fields.selection([('oerp', 'OpenERP'), ('postgresql', 'PostgreSQL')], 'Kind', required=True, help='Service using this port'),
+        'port': fields.integer('Port', required=True, help='Port number'),
+        'instance_id': fields.many2one('hosting.instance', 'Instance', ondelete='set null', select=True, help='Instance using this port, empty for a free port'),
+        'reserved': fields.boolean('Reserved', help='Checked for a port used by a PostgreSQL cluster waiting for an instance'),
+    }
+
+    _defaults = {
+        'reserved': False,
+    }
+
+    _sql_constraints = [
+        ('server_port_uniq', 'unique(server_id, port)', 'A port can only be allocated once per server !'),
+    ]
+
+    def allocate(self, cr, uid, server_id, kind, instance_id, context=None):
+        """
+        Returns the port of this kind allocated to the instance on the server, allocating it if needed
+        Free ports are reused first, then the lowest port never allocated in the range is taken
+        Instances created before the port allocator keep their legacy port (start port + instance id) when it is free
+        Legacy PostgreSQL ports are kept even outside of the range, since the existing clusters listen on them
+        """
+        cr.execute('SELECT port FROM hosting_port WHERE server_id = %s AND kind = %s AND instance_id = %s', (server_id, kind, instance_id))
+        allocated = cr.fetchone()
+        if allocated:
+            return allocated[0]
+
+        # Serialize the allocations on this server
+        cr.execute('SELECT %s_start_port, port_range_size FROM hosting_server WHERE id = %%s FOR UPDATE' % kind, (server_id,))
+        start_port, range_size = cr.fetchone()
+
+        legacy_port = start_port + instance_id
+        cr.execute('SELECT id FROM hosting_port WHERE server_id = %s AND port = %s', (server_id, legacy_port))
+        if (legacy_port < start_port + range_size or kind == 'postgresql') and not cr.fetchone() and self._legacy_port_in_use(cr, uid, server_id, kind, instance_id, context=context):
+            port = legacy_port
+        else:
+            port = self._next_free_port(cr, uid, server_id, kind, start_port, range_size, instance_id, context=context)
+            if port:
+                return port
+            port = self._next_new_port(cr, uid, server_id, kind, start_port, range_size, context=context)
+
+        self.create(cr, uid, {'server_id': server_id, 'kind': kind, 'port': port, 'instance_id': instance_id}, context=context)
+        return port
+
+    def reserve(self, cr, uid, server_id, kind, context=None):
+        """
+        Reserve a port of this kind on the server, without assigning it to an instance
+        """
+        cr.execute('SELECT %s_start_port, port_range_size FROM hosting_server WHERE id = %%s FOR UPDATE' % kind, (server_id,))
+        start_port, range_size = cr.fetchone()
+
+        port = self._next_free_port(cr, uid, server_id, kind, start_port, range_size, None, reserved=True, context=context)
+        if port:
+            return port
+
+        port = self._next_new_port(cr, uid, server_id, kind, start_port, range_size, context=context)
+        self.create(cr, uid, {'server_id': server_id, 'kind': kind, 'port': port, 'reserved': True}, context=context)
+        return port
+
+    def _next_free_port(self, cr, uid, server_id, kind, start_port, range_size, instance_id, reserved=False, context=None):
+        """
+        Assign the lowest released port, returns False if there is none
+        """
+        cr.execute('SELECT id, port FROM hosting_port WHERE server_id = %s AND kind = %s AND instance_id IS NULL AND NOT reserved ORDER BY port LIMIT 1', (server_id, kind))
+        free = cr.fetchone()
+        if not free:
+            return False
+
+        cr.execute('UPDATE hosting_port SET instance_id = %s, reserved = %s WHERE id = %s', (instance_id, reserved, free[0]))
+        return free[1]
+
+    def _next_new_port(self, cr, uid, server_id, kind, start_port, range_size, context=None):
+        """
+        Returns the lowest port of the range which was never allocated
+        Legacy ports of the instances provisioned before the port allocator, and not allocated yet, are skipped
+        """
+        cr.execute("""
+            SELECT candidate.port
+            FROM generate_series(%s, %s) AS candidate(port)
+            WHERE NOT EXISTS (SELECT 1 FROM hosting_port WHERE server_id = %s AND port = candidate.port)
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM hosting_instance instance
+                        JOIN hosting_variant variant ON variant.id = instance.variant_id
+                    WHERE variant.server_id = %s AND instance.provisioning_state = 'ready' AND instance.id = candidate.port - %s
+                        AND NOT EXISTS (SELECT 1 FROM hosting_port WHERE instance_id = instance.id AND kind = %s))
+            ORDER BY candidate.port
+            LIMIT 1""", (start_port, start_port + range_size - 1, server_id, server_id, start_port, kind))
+        port = cr.fetchone()
+        if not port:
+            raise orm.except_orm('Error', 'No more %s port available on this server' % kind)
+
+        return port[0]
+
+    def _legacy_port_in_use(self, cr, uid, server_id, kind, instance_id, context=None):
+        """
+        Returns True if the instance has been provisioned on this server before the port allocator existed
+        """
+        cr.execute("""
+            SELECT instance.id
+            FROM hosting_instance instance
+                JOIN hosting_variant variant ON variant.id = instance.variant_id
+            WHERE instance.id = %s AND variant.server_id = %s AND instance.provisioning_state = 'ready'
+                AND NOT EXISTS (SELECT 1 FROM hosting_port WHERE instance_id = instance.id AND kind = %s)""", (instance_id, server_id, kind))
+        return bool(cr.fetchone())
+
+    def allocate_missing_ports(self, cr, uid, context=None):
+        """
+        Allocate the ports of existing instances, keeping their legacy ports
+        """
+        instance_obj = self.pool.get('hosting.instance')
+        instance_ids = instance_obj.search(cr, uid, [], context=context)
+        return instance_obj.allocate_ports(cr, uid, instance_ids, context=context)
+
+
+class HostingPgCluster(orm.Model):
+    _name = 'hosting.pg.cluster'
+    _description = 'Hosting PostgreSQL Cluster'
+    _order = 'server_id, port'
+
+    _columns = {
+        'name': fields.char('Name', size=64, required=True, readonly=True, help='Name of the PostgreSQL cluster'),
+        'server_id': fields.many2one('hosting.server', 'Server', required=True, ondelete='cascade', readonly=True, select=True, help='Server hosting this cluster'),
+        'port': fields.integer('Port', required=True, readonly=True, help='Port of the cluster'),
+        'instance_id': fields.many2one('hosting.instance', 'Instance', ondelete='set null', readonly=True, help='Instance using this cluster, empty while the cluster waits in the pool'),
+        'state': fields.selection([('available', 'Available'), ('assigned', 'Assigned')], 'State', required=True, readonly=True, select=True, help='State of the cluster'),
+    }
+
+    def claim(self, cr, uid, server_id, instance_id, context=None):
+        """
+        Assign an available cluster of the server pool to the instance
+        Returns True if a cluster was available
+        """
+        cr.execute("SELECT id, name, port FROM hosting_pg_cluster WHERE server_id = %s AND state = 'available' ORDER BY port LIMIT 1 FOR UPDATE", (server_id,))
+        cluster = cr.fetchone()
+        if not cluster:
+            return False
+
+        cluster_id, cluster_name, port = cluster
+        self.write(cr, uid, [cluster_id], {'state': 'assigned', 'instance_id': instance_id}, context=context)
+        cr.execute("UPDATE hosting_port SET instance_id = %s, reserved = False WHERE server_id = %s AND port = %s", (instance_id, server_id, port))
+        cr.execute('UPDATE hosting_instance SET cluster_name = %s WHERE id = %s', (cluster_name, instance_id))
+        logger.info('%s - Assigned to instance %d' % (cluster_name, instance_id))
+
+        # Replace the cluster in the pool
+        self.pool.get('hosting.server').refill_pg_pool(cr, uid, [server_id], context=context)
 
         return True
 
+    def refill(self, cr, uid, server_id, context=None):
+        """
+        Create and start clusters until the pool of the server is full
+        """
+        server_obj = self.pool.get('hosting.server')
+        port_obj = self.pool.get('hosting.port')
+
+        server = server_obj.browse(cr, uid, server_id, context=context)
+        available_count = self.search(cr, uid, [('server_id', '=', server_id), ('state', '=', 'available')], count=True, context=context)
+        for index in range(server.pg_pool_size - available_count):
+            port = port_obj.reserve(cr, uid, server_id, 'postgresql', context=context)
+            cluster_name = '%spool%d' % (server.prefix, port)
+            logger.info('%s - Create PostgreSQL Cluster' % cluster_name)
+            server.create_pg_cluster(port, cluster_name)
+            self.create(cr, uid, {'name': cluster_name, 'server_id': server_id, 'port': port, 'state': 'available'}, context=context)
+
+        return True
+
+
+class HostingMetric(orm.Model):
+    _name = 'hosting.metric'
+    _description = 'Hosting Metric'
+    _order = 'date desc'
+    _log_access = False
+
+    # Age in days after which samples are averaged to the next resolution, or deleted for the last one
+    RETENTION = [
+        ('raw', 'hour', 2),
+        ('hour', 'day', 60),
+        ('day', None, 730),
+    ]
+
+    # Values of the instances stored as samples, booleans are stored as 0 or 1 to compute availability averages
+    METRICS = ['running', 'pg_alive', 'memory_rss', 'cpu_percent', 'disk_usage']
+
+    _columns = {
+        'instance_id': fields.many2one('hosting.instance', 'Instance', required=True, ondelete='cascade', readonly=True, help='Measured instance'),
+        'name': fields.selection([('running', 'Running'), ('pg_alive', 'PostgreSQL Online'), ('memory_rss', 'Memory (MB)'), ('cpu_percent', 'CPU (%)'), ('disk_usage', 'Filestore Size (MB)')], 'Metric', required=True, readonly=True, help='Measured value'),
+        'date': fields.datetime('Date', required=True, readonly=True, help='Date of the sample, or start of the averaged period'),
+        'resolution': fields.selection([('raw', 'Raw'), ('hour', 'Hour'), ('day', 'Day')], 'Resolution', required=True, readonly=True, help='Period averaged by this sample'),
+        'value': fields.float('Value', readonly=True, help='Measured value, or average of the period'),
+    }
+
+    def _auto_init(self, cr, context=None):
+        res = super(HostingMetric, self)._auto_init(cr, context=context)
+
+        # Samples are always read and downsampled by instance and metric, in date order
+        cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'hosting_metric_lookup_index'")
+        if not cr.fetchone():
+            cr.execute('CREATE INDEX hosting_metric_lookup_index ON hosting_metric (resolution, instance_id, name, date)')
+
+        return res
+
+    def store(self, cr, uid, date, samples, context=None):
+        """
+        Store the samples and the last values of the instances, with two queries whatever the number of instances
+        @param samples : List of (instance_id, values) tuples, values is a dict as returned by remote.collect_metrics, with the cpu_percent
+        Metrics whose value is None were not measured, and are left out of the history
+        """
+        if not samples:
+            return True
+
+        rows = []
+        for instance_id, values in samples:
+            measures = dict(values, running=values['process_state'] == 'RUNNING')
+            rows.extend((instance_id, name, date, float(measures[name])) for name in self.METRICS if measures[name] is not None)
+        cr.execute("INSERT INTO hosting_metric (instance_id, name, date, value, resolution) VALUES %s" % ', '.join(["(%s, %s, %s, %s, 'raw')"] * len(rows)), [value for row in rows for value in row])
+
+        # The filestore size is kept until its next measure
+        parameters = [value for instance_id, values in samples for value in (instance_id, values['process_state'], values['pg_alive'], values['memory_rss'], values['cpu_percent'], values['cpu_pid'], values['cpu_time'], values['cpu_uptime'], values['disk_usage'])]
+        cr.execute("""
+            UPDATE hosting_instance
+            SET process_state = data.process_state, pg_alive = data.pg_alive, memory_rss = data.memory_rss, cpu_percent = data.cpu_percent::float,
+                cpu_pid = data.cpu_pid, cpu_time = data.cpu_time, cpu_uptime = data.cpu_uptime, disk_usage = COALESCE(data.disk_usage::float, hosting_instance.disk_usage), metrics_date = %%s
+            FROM (VALUES %s) AS data(id, process_state, pg_alive, memory_rss, cpu_percent, cpu_pid, cpu_time, cpu_uptime, disk_usage)
+            WHERE hosting_instance.id = data.id""" % ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(samples)), [date] + parameters)
+
+        return True
+
+    def downsample(self, cr, uid, context=None):
+        """
+        Average the old samples by hour then by day, and delete the samples older than the retention period
+        """
+        for resolution, next_resolution, days in self.RETENTION:
+            limit = (datetime.now() - timedelta(days=days)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+            if next_resolution:
+                # Only complete periods are averaged
+                cr.execute("""
+                    INSERT INTO hosting_metric (instance_id, name, date, value, resolution)
+                    SELECT instance_id, name, date_trunc(%s, date), avg(value), %s
+                    FROM hosting_metric
+                    WHERE resolution = %s AND date < date_trunc(%s, %s::timestamp)
+                    GROUP BY instance_id, name, date_trunc(%s, date)""", (next_resolution, next_resolution, resolution, next_resolution, limit, next_resolution))
+                cr.execute('DELETE FROM hosting_metric WHERE resolution = %s AND date < date_trunc(%s, %s::timestamp)', (resolution, next_resolution, limit))
+            else:
+                cr.execute('DELETE FROM hosting_metric WHERE resolution = %s AND date < %s', (resolution, limit))
+
+        return True
+
+
+class HostingTrace(orm.Model):
+    _name = 'hosting.trace'
+    _description = 'Hosting Trace'
+    _order = 'date desc'
+
+    # Age in days after which traces are deleted
+    RETENTION_DAYS = 30
+
+    _columns = {
+        'name': fields.char('Operation', size=128, required=True, readonly=True, help='Traced operation'),
+        'date': fields.datetime('Date', required=True, readonly=True, help='Start of the operation'),
+        'duration': fields.float('Duration', readonly=True, help='Duration of the operation, in seconds'),
+        'span_count': fields.integer('Spans', readonly=True, help='Number of timed stages'),
+        'job_id': fields.many2one('hosting.job', 'Job', ondelete='set null', readonly=True, help='Job which ran this operation'),
+        'report': fields.text('Report', readonly=True, help='Durations aggregated by operation and by server, and slowest spans, in JSON'),
+    }
+
+    def store(self, dbname, uid, trace, job_id=False, context=None):
+        """
+        Store the report of a trace in its own transaction, to keep the traces of failed operations
+        """
+        report = trace.report()
+        cr = pooler.get_db(dbname).cursor()
+        try:
+            self.create(cr, uid, {
+                'name': trace.name,
+                'date': datetime.fromtimestamp(trace.start).strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                'duration': trace.duration,
+                'span_count': report['span_count'],
+                'job_id': job_id,
+                'report': json.dumps(report, indent=4, sort_keys=True),
+            }, context=context)
+            cr.commit()
+        except Exception:
+            cr.rollback()
+            logger.exception('%s - Unable to store the trace' % trace.name)
+        finally:
+            cr.close()
+
+        return True
+
+    def get_report(self, cr, uid, ids, context=None):
+        """
+        Returns the reports of the traces, keyed by trace id
+        """
+        return dict((trace['id'], json.loads(trace['report'] or '{}')) for trace in self.read(cr, uid, ids, ['report'], context=context))
+
+    def purge(self, cr, uid, context=None):
+        """
+        Delete the traces older than the retention period
+        """
+        limit = (datetime.now() - timedelta(days=self.RETENTION_DAYS)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cr.execute('DELETE FROM hosting_trace WHERE date < %s', (limit,))
+        return True
+
+
+class HostingBackup(orm.Model):
+    _name = 'hosting.backup'
+    _description = 'Hosting Backup'
+    _order = 'id desc'
+
+    _columns = {
+        'name': fields.char('Name', size=128, required=True, readonly=True, help='Name of the backup'),
+        'instance_id': fields.many2one('hosting.instance', 'Instance', ondelete='set null', readonly=True, select=True, help='Instance saved in this backup'),
+        'instance_name': fields.char('Instance Name', size=64, required=True, readonly=True, help='Name of the saved instance, kept when the instance is deleted'),
+        'variant_id': fields.many2one('hosting.variant', 'Variant', ondelete='set null', readonly=True, help='Variant used by the instance, and by default by the instances restored from this backup'),
+        'server_id': fields.many2one('hosting.server', 'Server', required=True, ondelete='cascade', readonly=True, select=True, help='Server storing this backup'),
+        'state': fields.selection(BACKUP_STATES, 'State', required=True, readonly=True, select=True, help='State of the backup'),
+        'date': fields.datetime('Date', readonly=True, help='Date of the end of the backup'),
+        'path': fields.char('Path', size=512, readonly=True, help='Directory of the backup on the server'),
+        'previous_id': fields.many2one('hosting.backup', 'Previous Backup', ondelete='set null', readonly=True, help='Backup whose unchanged filestore files are shared with this backup'),
+        'databases': fields.text('Databases', readonly=True, help='Names of the saved databases, one per line'),
+        'size': fields.float('Size (MB)', readonly=True, help='Disk space used by this backup, without the files shared with the previous backup'),
+        'duration': fields.float('Duration', readonly=True, help='Duration of the backup, in seconds'),
+        'error': fields.text('Error', readonly=True, help='Error raised by the last attempt'),
+    }
+
+    _defaults = {
+        'state': 'queued',
+    }
+
+    @_traced('backup')
+    def execute(self, cr, uid, ids, context=None):
+        """
+        Save the queued backups, servers being processed in parallel and the backups of a server one after the other
+        The filestore of each backup shares its unchanged files with the previous backup of the instance
+        """
+        if context is None:
+            context = {}
+
+        instance_obj = self.pool.get('hosting.instance')
+        server_obj = self.pool.get('hosting.server')
+
+        backup_ids = self.search(cr, uid, [('id', 'in', ids), ('state', '=', 'queued'), ('instance_id', '!=', False)], context=context)
+        if not backup_ids:
+            return True
+
+        backups = self.browse(cr, uid, backup_ids, context=context)
+        instances = instance_obj._get_instance_data(cr, uid, list(set(backup.instance_id.id for backup in backups)), context=context)
+
+        servers = {}
+        server_backups = defaultdict(list)
+        for backup in backups:
+            instance = instances[backup.instance_id.id]
+            if instance['server']['id'] not in servers:
+                servers[instance['server']['id']] = server_obj._get_server_params(instance['server'])
+            params = servers[instance['server']['id']]
+
+            previous_ids = self.search(cr, uid, [('instance_id', '=', instance['id']), ('server_id', '=', params['id']), ('state', '=', 'done')], limit=1, order='date desc', context=context)
+            previous = previous_ids and self.read(cr, uid, previous_ids[0], ['path'], context=context) or {'id': False, 'path': None}
+            server_backups[params['id']].append({
+                'id': backup.id,
+                'source': instance_obj._get_database_location(instance),
+                'destination': '%s/%s/%d' % (params['backups_path'], instance['name'], backup.id),
+                'previous_id': previous['id'],
+                'previous_path': previous['path'],
+            })
+
+        def backup_server(server_id):
+            results = {}
+            for backup in server_backups[server_id]:
+                results[backup['id']] = remote.backup_instance(servers[server_id], backup['source'], backup['destination'], previous=backup['previous_path'])
+            return results
+
+        results = remote.run_in_parallel(dict((server_id, lambda server_id=server_id: backup_server(server_id)) for server_id in servers), max_workers=context.get('hosting_max_workers', remote.MAX_WORKERS))
+
+        errors = ['%s : %s' % (servers[server_id]['name'], exception) for server_id, (result, exception) in sorted(results.items()) if exception is not None]
+        if errors:
+            raise orm.except_orm('Error', '\n'.join(errors))
+
+        now = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        for server_id, (server_results, exception) in results.items():
+            for backup in server_backups[server_id]:
+                result = server_results[backup['id']]
+                self.write(cr, uid, [backup['id']], {
+                    'state': 'done',
+                    'date': now,
+                    'server_id': server_id,
+                    'path': backup['destination'],
+                    'previous_id': backup['previous_id'],
+                    'databases': '\n'.join(result['databases']),
+                    'size': result['size'] / 1024.0,
+                    'duration': result['duration'],
+                    'error': False,
+                }, context=context)
+
+        return True
+
+    def _restored_database_name(self, backup, instance, database):
+        """
+        Returns the name of a database of the backup, once restored in the instance
+        Databases restored in a shared cluster are prefixed by the instance name, to avoid conflicts with the databases of the other instances
+        """
+        if instance['postgresql_mode'] != 'shared':
+            return database
+
+        if database.startswith(backup.instance_name + '_'):
+            database = database[len(backup.instance_name) + 1:]
+        return '%s_%s' % (instance['name'], database)
+
+    @_traced('restore')
+    def restore(self, cr, uid, ids, instance_id, context=None):
+        """
+        Restore a backup into an instance without databases, hosted on the server storing the backup
+        """
+        # Check that we call this method on a single id only
+        assert len(ids) == 1, 'The restore method must be called on a single id'
+
+        instance_obj = self.pool.get('hosting.instance')
+        server_obj = self.pool.get('hosting.server')
+
+        backup = self.browse(cr, uid, ids[0], context=context)
+        if backup.state != 'done':
+            raise orm.except_orm('Error', 'The backup %s is not complete' % backup.name)
+        instance = instance_obj._get_instance_data(cr, uid, [instance_id], context=context)[instance_id]
+        if instance['server']['id'] != backup.server_id.id:
+            raise orm.except_orm('Error', 'The backup %s can only be restored on %s' % (backup.name, backup.server_id.name))
+
+        location = instance_obj._get_database_location(instance)
+        target = dict(location, owner=location['owner'] or instance['server']['system_username'], databases=dict(
+            (database, self._restored_database_name(backup, instance, database))
+            for database in (backup.databases or '').splitlines()
+        ))
+        try:
+            remote.restore_instance(server_obj._get_server_params(instance['server']), backup.path, target)
+        except remote.CommandError, e:
+            raise orm.except_orm('Error', '%s : %s' % (instance['name'], e))
+
+        return True
+
+    def restore_to_new_instance(self, cr, uid, ids, context=None):
+        """
+        Create a new instance for each backup, and restore the backup in it
+        Queued backups are saved first, in the same job as their restore
+        The variant of the new instances can be given in the hosting_variant_id context key, defaults to the variant of the saved instance
+        Returns the list of created instance ids
+        """
+        if context is None:
+            context = {}
+
+        instance_obj = self.pool.get('hosting.instance')
+        variant_id = context.get('hosting_variant_id')
+        variant = variant_id and self.pool.get('hosting.variant').browse(cr, uid, variant_id, context=context)
+
+        instance_ids = []
+        for backup in self.browse(cr, uid, ids, context=context):
+            if backup.state == 'failed':
+                raise orm.except_orm('Error', 'The backup %s failed' % backup.name)
+            if not (variant or backup.variant_id):
+                raise orm.except_orm('Error', 'No variant to restore the backup %s' % backup.name)
+            # The backup files are only available on the server storing them
+            if (variant or backup.variant_id).server_id.id != backup.server_id.id:
+                raise orm.except_orm('Error', 'The backup %s can only be restored on %s' % (backup.name, backup.server_id.name))
+
+            # The new instance is provisioned with the restore
+            instance_id = instance_obj.create(cr, uid, {'variant_id': (variant or backup.variant_id).id}, context=dict(context, hosting_defer_provision=True))
+            instance_ids.append(instance_id)
+
+            if context.get('hosting_synchronous'):
+                self.execute(cr, uid, [backup.id], context=context)
+                instance_obj.provision(cr, uid, [instance_id], context=context)
+                self.restore(cr, uid, [backup.id], instance_id, context=context)
+                continue
+
+            self.pool.get('hosting.job').create(cr, uid, {
+                'name': 'Restore %s into a new instance' % backup.name,
+                'job_type': 'restore',
+                'server_id': backup.server_id.id,
+                'instance_id': instance_id,
+                'backup_id': backup.id,
+            }, context=context)
+
+        return instance_ids
+
+    def unlink(self, cr, uid, ids, context=None):
+        """
+        Remove the backup directories from the servers, then delete the backups
+        Files shared with other backups are hard links, and stay available for them
+        """
+        if context is None:
+            context = {}
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+
+        server_obj = self.pool.get('hosting.server')
+
+        servers = {}
+        server_paths = defaultdict(list)
+        for backup in self.browse(cr, uid, ids, context=context):
+            if backup.path:
+                servers[backup.server_id.id] = server_obj._get_server_params(backup.server_id)
+                server_paths[backup.server_id.id].append(backup.path)
+
+        results = remote.run_in_parallel(dict((server_id, lambda server_id=server_id: remote.remove_backups(servers[server_id], server_paths[server_id])) for server_id in servers), max_workers=context.get('hosting_max_workers', remote.MAX_WORKERS))
+        errors = ['%s : %s' % (servers[server_id]['name'], exception) for server_id, (result, exception) in sorted(results.items()) if exception is not None]
+        if errors:
+            raise orm.except_orm('Error', '\n'.join(errors))
+
+        return super(HostingBackup, self).unlink(cr, uid, ids, context=context)
+
+
+class HostingJob(orm.Model):
+    _name = 'hosting.job'
+    _description = 'Hosting Job'
+    _order = 'next_date, id'
+
+    # Delay before the first retry of a failed job, doubled after each attempt
+    RETRY_DELAY = 60
+    # Delay after which a job still running is considered as dead
+    RUNNING_TIMEOUT = 3600
+
+    _columns = {
+        'name': fields.char('Name', size=128, required=True, readonly=True, help='Description of the job'),
+        'job_type': fields.selection([('provision', 'Provision Instance'), ('update', 'Update Configuration Files'), ('apache_reload', 'Reload Apache'), ('refill_pg_pool', 'Refill PostgreSQL Pool'), ('backup', 'Back Up Instance'), ('restore', 'Restore Backup')], 'Type', required=True, readonly=True, help='Operation executed by this job'),
+        'server_id': fields.many2one('hosting.server', 'Server', required=True, ondelete='cascade', readonly=True, select=True, help='Server on which the job runs'),
+        'instance_id': fields.many2one('hosting.instance', 'Instance', ondelete='cascade', readonly=True, help='Instance concerned by this job'),
+        'instance_ids': fields.many2many('hosting.instance', 'hosting_job_instance_rel', 'job_id', 'instance_id', 'Instances', readonly=True, help='Instances concerned by this job, when it handles several instances at once'),
+        'backup_id': fields.many2one('hosting.backup', 'Backup', ondelete='cascade', readonly=True, help='Backup saved or restored by this job'),
+        'state': fields.selection([('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], 'State', required=True, readonly=True, select=True, help='State of the job'),
+        'attempts': fields.integer('Attempts', readonly=True, help='Number of times this job has been started'),
+        'max_attempts': fields.integer('Maximum Attempts', required=True, help='Number of attempts before the job is considered as failed'),
+        'next_date': fields.datetime('Next Execution Date', required=True, readonly=True, help='Date from which the job can be started'),
+        'date_start': fields.datetime('Start Date', readonly=True, help='Date of the last start of the job'),
+        'date_done': fields.datetime('End Date', readonly=True, help='Date of the end of the job'),
+        'error': fields.text('Error', readonly=True, help='Error raised by the last attempt'),
+    }
+
+    _defaults = {
+        'state': 'queued',
+        'attempts': 0,
+        'max_attempts': 5,
+        'next_date': lambda *a: datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+    }
+
+    # Job types which can't run simultaneously on a same server
+    EXCLUSIVE_JOB_TYPES = ['update', 'apache_reload', 'refill_pg_pool']
+    # Job types limited by the maximum number of running backups of the server
+    BACKUP_JOB_TYPES = ['backup', 'restore']
+
+    def enqueue_unique(self, cr, uid, job_type, server_id, name, delay=0, context=None):
+        """
+        Queue a job for the server, unless one of the same type is already queued
+        The start of the queued job is then postponed, to merge all requests received during the delay
+        """
+        next_date = (datetime.now() + timedelta(seconds=delay)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        job_ids = self.search(cr, uid, [('job_type', '=', job_type), ('server_id', '=', server_id), ('state', '=', 'queued')], context=context)
+        if job_ids:
+            self.write(cr, uid, job_ids, {'next_date': next_date}, context=context)
+            return job_ids[0]
+
+        return self.create(cr, uid, {
+            'name': name,
+            'job_type': job_type,
+            'server_id': server_id,
+            'next_date': next_date,
+        }, context=context)
+
+    def retry(self, cr, uid, ids, context=None):
+        """
+        Put failed jobs back in the queue
+        """
+        return self.write(cr, uid, ids, {
+            'state': 'queued',
+            'attempts': 0,
+            'next_date': datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+        }, context=context)
+
+    def run_jobs(self, cr, uid, context=None):
+        """
+        Start the queued jobs, without exceeding the number of running jobs allowed on each server
+        Each job runs in its own thread and transaction, the next runs don't wait for the end of the started jobs
+        """
+        now = datetime.now()
+
+        # Put back in the queue the jobs whose worker died, backups and restores may run several commands up to the backup timeout
+        dead_job_ids = []
+        for job in self.browse(cr, uid, self.search(cr, uid, [('state', '=', 'running'), ('date_start', '<', (now - timedelta(seconds=self.RUNNING_TIMEOUT)).strftime(DEFAULT_SERVER_DATETIME_FORMAT))], context=context), context=context):
+            timeout = self.RUNNING_TIMEOUT
+            if job.job_type in self.BACKUP_JOB_TYPES:
+                timeout += 3 * job.server_id.backup_timeout
+            if job.date_start < (now - timedelta(seconds=timeout)).strftime(DEFAULT_SERVER_DATETIME_FORMAT):
+                dead_job_ids.append(job.id)
+        if dead_job_ids:
+            self.write(cr, uid, dead_job_ids, {'state': 'queued'}, context=context)
+
+        cr.execute("SELECT server_id, count(*) FROM hosting_job WHERE state = 'running' GROUP BY server_id")
+        running = dict(cr.fetchall())
+        cr.execute("SELECT DISTINCT server_id, job_type FROM hosting_job WHERE state = 'running' AND job_type IN %s", (tuple(self.EXCLUSIVE_JOB_TYPES),))
+        running_exclusive = set(cr.fetchall())
+        cr.execute("SELECT server_id, count(*) FROM hosting_job WHERE state = 'running' AND job_type IN %s GROUP BY server_id", (tuple(self.BACKUP_JOB_TYPES),))
+        running_backups = dict(cr.fetchall())
+
+        job_ids = []
+        job_id_list = self.search(cr, uid, [('state', '=', 'queued'), ('next_date', '<=', now.strftime(DEFAULT_SERVER_DATETIME_FORMAT))], context=context)
+        for job in self.browse(cr, uid, job_id_list, context=context):
+            if running.get(job.server_id.id, 0) >= job.server_id.max_running_jobs:
+                continue
+            if job.job_type in self.BACKUP_JOB_TYPES:
+                if running_backups.get(job.server_id.id, 0) >= job.server_id.max_running_backups:
+                    continue
+                running_backups[job.server_id.id] = running_backups.get(job.server_id.id, 0) + 1
+            if job.job_type in self.EXCLUSIVE_JOB_TYPES:
+                if (job.server_id.id, job.job_type) in running_exclusive:
+                    continue
+                running_exclusive.add((job.server_id.id, job.job_type))
+            running[job.server_id.id] = running.get(job.server_id.id, 0) + 1
+            job_ids.append(job.id)
+
+        # Take the jobs before the workers start, the next runs count them as running
+        if job_ids:
+            cr.execute("UPDATE hosting_job SET state = 'running', attempts = attempts + 1, date_start = %s WHERE id IN %s AND state = 'queued' RETURNING id", (now.strftime(DEFAULT_SERVER_DATETIME_FORMAT), tuple(job_ids)))
+            job_ids = [row[0] for row in cr.fetchall()]
+        cr.commit()
+
+        dbname = cr.dbname
+        for job_id in job_ids:
+            thread = threading.Thread(target=self._run_job, args=(dbname, uid, job_id), kwargs={'context': context}, name='hosting.job-%d' % job_id)
+            thread.start()
+
+        return True
+
+    def _run_job(self, dbname, uid, job_id, context=None):
+        """
+        Execute a job taken by run_jobs, in a new transaction
+        """
+        cr = pooler.get_db(dbname).cursor()
+        try:
+            job = self.browse(cr, uid, job_id, context=context)
+            logger.info('%s - Start job' % job.name)
+            trace = instrumentation.Trace(job.name)
+            try:
+                with instrumentation.activate(trace):
+                    getattr(self, '_run_%s' % job.job_type)(cr, uid, job, context=context)
+            except Exception:
+                cr.rollback()
+                logger.exception('%s - Job failed' % job.name)
+                self._job_failed(cr, uid, job_id, traceback.format_exc(), context=context)
+            else:
+                self.write(cr, uid, [job_id], {'state': 'done', 'date_done': datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT), 'error': False}, context=context)
+            cr.commit()
+            trace.close()
+            self.pool.get('hosting.trace').store(dbname, uid, trace, job_id=job_id, context=context)
+        finally:
+            cr.close()
+
+        return True
+
+    def _job_failed(self, cr, uid, job_id, error, context=None):
+        """
+        Schedule the next attempt of a job, with an exponential backoff
+        """
+        job = self.browse(cr, uid, job_id, context=context)
+        values = {'error': error}
+        if job.attempts >= job.max_attempts:
+            values['state'] = 'failed'
+            values['date_done'] = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+            if job.instance_id and job.job_type in ('provision', 'restore'):
+                self.pool.get('hosting.instance')._set_provisioning_state(cr, uid, [job.instance_id.id], 'failed', context=context)
+            if job.backup_id and job.backup_id.state == 'queued':
+                self.pool.get('hosting.backup').write(cr, uid, [job.backup_id.id], {'state': 'failed', 'error': error}, context=context)
+        else:
+            values['state'] = 'queued'
+            values['next_date'] = (datetime.now() + timedelta(seconds=self.RETRY_DELAY * 2 ** (job.attempts - 1))).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+
+        return self.write(cr, uid, [job_id], values, context=context)
+
+    def _run_provision(self, cr, uid, job, context=None):
+        """
+        Create the PostgreSQL clusters and the configuration files of the instances
+        """
+        instance_ids = [instance.id for instance in job.instance_ids] or job.instance_id and [job.instance_id.id] or []
+        if not instance_ids:
+            return True
+
+        return self.pool.get('hosting.instance').provision(cr, uid, instance_ids, context=context)
+
+    def _run_update(self, cr, uid, job, context=None):
+        """
+        Update the configuration files of all outdated instances of the server at once
+        """
+        instance_obj = self.pool.get('hosting.instance')
+        instance_ids = instance_obj.search(cr, uid, [('variant_id.server_id', '=', job.server_id.id), ('config_dirty', '=', True)], context=context)
+        if not instance_ids:
+            return True
+
+        # Instances marked again during the update will be handled by a new job
+        cr.execute('UPDATE hosting_instance SET config_dirty = False WHERE id IN %s', (tuple(instance_ids),))
+        return instance_obj.update_configuration_files(cr, uid, instance_ids, context=context)
+
+    def _run_refill_pg_pool(self, cr, uid, job, context=None):
+        """
+        Create the missing clusters in the PostgreSQL pool of the server
+        """
+        return self.pool.get('hosting.pg.cluster').refill(cr, uid, job.server_id.id, context=context)
+
+    def _run_backup(self, cr, uid, job, context=None):
+        """
+        Save the backup of an instance
+        """
+        return self.pool.get('hosting.backup').execute(cr, uid, [job.backup_id.id], context=context)
+
+    def _run_restore(self, cr, uid, job, context=None):
+        """
+        Save the backup if needed, provision the new instance, then restore the backup in it
+        Each step is committed, the next attempts continue from the first unfinished step
+        """
+        backup_obj = self.pool.get('hosting.backup')
+        instance_obj = self.pool.get('hosting.instance')
+
+        if job.backup_id.state == 'queued':
+            backup_obj.execute(cr, uid, [job.backup_id.id], context=context)
+            cr.commit()
+
+        if job.instance_id.provisioning_state != 'ready':
+            instance_obj.provision(cr, uid, [job.instance_id.id], context=context)
+            cr.commit()
+
+        return backup_obj.restore(cr, uid, [job.backup_id.id], job.instance_id.id, context=context)
+
+    def _run_apache_reload(self, cr, uid, job, context=None):
+        """
+        Check and reload the apache configuration of the server
+        """
+        return self.pool.get('hosting.server').reload_apache_configuration(cr, uid, [job.server_id.id], context=context)
+
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    hosting module for OpenERP, Allow to very simply create and manage new OpenERP instances
+#    Copyright (C) 2014 SYLEAM Info Services (<http://www.Syleam.fr/>)
+#              Sylvain Garancher <sylvain.garancher@syleam.fr>
+#
+#    This file is a part of hosting
+#
+#    hosting is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    hosting is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Timing spans of the operations made on the hosting servers
+A trace collects the spans of an operation, in its thread and in the worker threads it starts
+Outside of a trace, opening a span only costs a thread local lookup
+"""
+
+import time
+import functools
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Number of slowest spans kept in the report of a trace
+SLOWEST_SPANS = 20
+
+_local = threading.local()
+
+
+class Trace(object):
+    """
+    Spans recorded during an operation
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        # Tuples of (operation, server, instance, start, duration, failed), list.append is thread safe
+        self.spans = []
+
+    def close(self):
+        self.duration = time.time() - self.start
+
+    def has_remote_spans(self):
+        """
+        Returns True if something was done on a server during the trace
+        """
+        return any(span[1] for span in self.spans)
+
+    def report(self):
+        """
+        Returns the spans aggregated by operation and by server, and the slowest ones
+        """
+        operations = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0, 'failed': 0})
+        servers = defaultdict(lambda: defaultdict(float))
+        for operation, server, instance, start, duration, failed in self.spans:
+            totals = operations[operation]
+            totals['count'] += 1
+            totals['total'] += duration
+            totals['max'] = max(totals['max'], duration)
+            totals['failed'] += failed
+            if server:
+                servers[server][operation] += duration
+
+        slowest = sorted(self.spans, key=lambda span: span[4], reverse=True)[:SLOWEST_SPANS]
+        return {
+            'name': self.name,
+            'duration': self.duration,
+            'span_count': len(self.spans),
+            'operations': dict(operations),
+            'servers': dict((server, dict(totals)) for server, totals in servers.items()),
+            'slowest': [{
+                'operation': operation,
+                'server': server,
+                'instance': instance,
+                'offset': start - self.start,
+                'duration': duration,
+                'failed': failed,
+            } for operation, server, instance, start, duration, failed in slowest],
+        }
+
+
+def current_trace():
+    """
+    Returns the trace active in this thread, or None
+    """
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def activate(trace):
+    """
+    Record the spans of this thread in the trace
+    """
+    previous = getattr(_local, 'trace', None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextmanager
+def span(operation, server=None, instance=None):
+    """
+    Measure the duration of the enclosed code, if a trace is active
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+
+    start = time.time()
+    failed = False
+    try:
+        yield
+    except:
+        failed = True
+        raise
+    finally:
+        trace.spans.append((operation, server, instance, start, time.time() - start, failed))
+
+
+def timed(operation):
+    """
+    Decorator opening a span around a function which takes the server parameters as first argument
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(params, *args, **kwargs):
+            with span(operation, params['name']):
+                return function(params, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,1041 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    hosting module for OpenERP, Allow to very simply create and manage new OpenERP instances
+#    Copyright (C) 2014 SYLEAM Info Services (<http://www.Syleam.fr/>)
+#              Sylvain Garancher <sylvain.garancher@syleam.fr>
+#
+#    This file is a part of hosting
+#
+#    hosting is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    hosting is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Operations on the hosting servers which don't need any database cursor
+They take a dict of server parameters (see HostingServer._get_server_params), and can be called from worker threads
+"""
+
+import os
+import re
+import math
+import time
+import pipes
+import Queue
+import signal
+import socket
+import hashlib
+import xmlrpclib
+import threading
+import subprocess
+import paramiko
+from contextlib import contextmanager
+from connection_pool import ssh_pool
+from connection_pool import supervisor_clients
+import instrumentation
+import logging
+logger = logging.getLogger('hosting')
+
+# Default number of servers processed simultaneously
+MAX_WORKERS = 8
+
+# Delay in seconds between two checks of a running command
+POLL_INTERVAL = 0.05
+
+# Size of the data read at once on SSH channels
+BUFFER_SIZE = 32768
+
+# Delay in seconds between the interruption of a timed out remote command and its kill
+KILL_DELAY = 10
+
+# Maximum number of vhosts disabled by an apache reload
+MAX_DISABLED_VHOSTS = 5
+
+# Finds the file containing the error in the apache configuration test output
+APACHE_ERROR_FILE = re.compile(r' of (/\S+?):')
+
+# Line separating the outputs of the commands run to collect metrics
+METRICS_SEPARATOR = '--hosting-metrics--'
+
+# CGI script called by apache when an instance doesn't answer, starts the instance and asks the browser to retry
+WAKEUP_SCRIPT = '''#!/usr/bin/env python
+import os
+import socket
+import xmlrpclib
+
+RETRY_DELAY = 5
+
+name = os.environ.get('HOSTING_INSTANCE', '')
+try:
+    xmlrpclib.ServerProxy(%(supervisor_url)r).supervisor.startProcessGroup(name, False)
+    message = 'Starting, please wait...'
+except xmlrpclib.Fault, e:
+    # 60 : ALREADY_STARTED
+    message = e.faultCode == 60 and 'Starting, please wait...' or 'This instance is not available'
+except socket.error:
+    message = 'This instance is not available'
+
+print 'Status: 503 Service Unavailable'
+print 'Retry-After: %%d' %% RETRY_DELAY
+print 'Content-Type: text/html'
+print
+print '<html><head><meta http-equiv="refresh" content="%%d"/></head><body>%%s</body></html>' %% (RETRY_DELAY, message)
+'''
+
+# pgbouncer configuration, all databases are forwarded to the shared cluster with the credentials of the client
+PGBOUNCER_CONFIG = '''[databases]
+* = host=127.0.0.1 port=%(shared_cluster_port)d
+
+[pgbouncer]
+listen_addr = 127.0.0.1
+listen_port = %(pgbouncer_port)d
+unix_socket_dir = %(postgresql_pid_path)s
+auth_type = md5
+auth_file = %(pgbouncer_path)s/userlist.txt
+pidfile = %(pgbouncer_path)s/pgbouncer.pid
+pool_mode = %(pgbouncer_pool_mode)s
+default_pool_size = %(pgbouncer_pool_size)d
+max_client_conn = %(pgbouncer_max_client_conn)d
+'''
+
+# Supervisor program running pgbouncer
+PGBOUNCER_PROGRAM = '''[program:%(prefix)spgbouncer]
+command=/usr/sbin/pgbouncer %(pgbouncer_path)s/pgbouncer.ini
+user=%(system_username)s
+autorestart=true
+'''
+
+
+@contextmanager
+def closing(fileobject):
+    """
+    Decorated function used to automatically close paramiko sftp fileobjects
+    """
+    try:
+        yield fileobject
+    finally:
+        fileobject.close()
+
+
+@contextmanager
+def ssh_connection(params):
+    """
+    Yields a pooled SSH connection to the server
+    """
+    with ssh_pool.connection(params['id'], params['ssh'], max_size=params['ssh_pool_size'], idle_timeout=params['ssh_idle_timeout'], name=params['name']) as connection:
+        yield connection
+
+
+class CommandResult(object):
+    """
+    Result of a command executed on a server
+    """
+    def __init__(self, command):
+        self.command = command
+        self.exit_code = None
+        self.stdout = ''
+        self.stderr = ''
+        self.duration = 0.0
+        self.timed_out = False
+
+    @property
+    def success(self):
+        return self.exit_code == 0 and not self.timed_out
+
+    def to_dict(self):
+        return {
+            'command': ' '.join(self.command),
+            'exit_code': self.exit_code if self.exit_code is not None else -1,
+            'stdout': self.stdout,
+            'stderr': self.stderr,
+            'duration': self.duration,
+            'timed_out': self.timed_out,
+        }
+
+
+class CommandError(Exception):
+    def __init__(self, result):
+        self.result = result
+        if result.timed_out:
+            message = '%s : Timed out after %.1f seconds' % (' '.join(result.command), result.duration)
+        else:
+            message = '%s : Exited with status %s\n%s' % (' '.join(result.command), result.exit_code, result.stderr)
+        super(CommandError, self).__init__(message)
+
+
+class _OutputStream(object):
+    """
+    Collects the output of a command, and logs each line as soon as it is complete
+    """
+    def __init__(self, prefix, log_level):
+        self.prefix = prefix
+        self.log_level = log_level
+        self.chunks = []
+        self.pending = ''
+
+    def feed(self, data):
+        self.chunks.append(data)
+        if self.log_level is None:
+            return
+
+        lines = (self.pending + data).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            logger.log(self.log_level, '%s - %s' % (self.prefix, line.rstrip()))
+
+    def close(self):
+        if self.pending and self.log_level is not None:
+            logger.log(self.log_level, '%s - %s' % (self.prefix, self.pending.rstrip()))
+        self.pending = ''
+        return ''.join(self.chunks)
+
+
+def _read_pipe(pipe, stream):
+    for line in iter(pipe.readline, ''):
+        stream.feed(line)
+    pipe.close()
+
+
+def _run_local_command(command, result, stdout, stderr, deadline):
+    # The command runs in its own process group, to be able to kill its children too
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+    readers = [
+        threading.Thread(target=_read_pipe, args=(process.stdout, stdout)),
+        threading.Thread(target=_read_pipe, args=(process.stderr, stderr)),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    # The outputs are closed when the process exits
+    for reader in readers:
+        reader.join(max(deadline - time.time(), 0))
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            process.kill()
+        result.timed_out = True
+    result.exit_code = process.wait()
+    for reader in readers:
+        reader.join(POLL_INTERVAL)
+
+
+def _run_remote_command(params, command, result, stdout, stderr, deadline):
+    # Closing the channel doesn't stop the remote process, the server interrupts it by itself a bit after the deadline
+    # TERM is sent to the whole process group, then KILL if it still runs, sudo passes TERM to the commands it runs
+    timeout_command = ['timeout', '-s', 'TERM', '-k', str(KILL_DELAY), str(int(math.ceil(max(deadline - time.time(), 1))))] + list(command)
+    with ssh_connection(params) as connection:
+        channel = connection.client.get_transport().open_session()
+        try:
+            channel.exec_command(' '.join(pipes.quote(argument) for argument in timeout_command))
+            while True:
+                received = False
+                if channel.recv_ready():
+                    stdout.feed(channel.recv(BUFFER_SIZE))
+                    received = True
+                if channel.recv_stderr_ready():
+                    stderr.feed(channel.recv_stderr(BUFFER_SIZE))
+                    received = True
+                if received:
+                    continue
+
+                if channel.exit_status_ready():
+                    result.exit_code = channel.recv_exit_status()
+                    break
+                if time.time() >= deadline:
+                    result.timed_out = True
+                    break
+                time.sleep(POLL_INTERVAL)
+        finally:
+            channel.close()
+
+
+def _command_name(command):
+    """
+    Returns the name of the executed program, without its path and without sudo
+    """
+    if command[0].endswith('sudo') and len(command) > 1:
+        command = command[1:]
+    return os.path.basename(command[0])
+
+
+def run_command(params, command, timeout=None, log_output=True):
+    """
+    Execute a command on the server, locally or remotely
+    Output lines are logged as soon as they are received
+    @param timeout : Maximum duration of the command in seconds, defaults to the command timeout of the server
+    Returns a CommandResult
+    """
+    if timeout is None:
+        timeout = params['command_timeout']
+
+    result = CommandResult(command)
+    stdout = _OutputStream(params['name'], logging.INFO if log_output else None)
+    stderr = _OutputStream(params['name'], logging.WARNING if log_output else None)
+
+    start = time.time()
+    try:
+        with instrumentation.span('command %s' % _command_name(command), params['name']):
+            if params['local']:
+                _run_local_command(command, result, stdout, stderr, start + timeout)
+            else:
+                _run_remote_command(params, command, result, stdout, stderr, start + timeout)
+    finally:
+        result.duration = time.time() - start
+        result.stdout = stdout.close()
+        result.stderr = stderr.close()
+
+    if result.timed_out:
+        logger.error('%s - %s : Timed out after %.1f seconds' % (params['name'], ' '.join(command), result.duration))
+
+    return result
+
+
+def execute_command(params, command, timeout=None, log_output=True, check=True):
+    """
+    Execute a command on the server, locally or remotely
+    @param check : If True, raise a CommandError when the command fails or times out
+    Returns a CommandResult
+    """
+    result = run_command(params, command, timeout=timeout, log_output=log_output)
+    if check and not result.success:
+        raise CommandError(result)
+
+    return result
+
+
+def execute_commands(servers, commands, max_workers=MAX_WORKERS):
+    """
+    Execute commands on several servers simultaneously
+    The commands of a same server are executed in order
+    @param servers : Dict of server parameters, keyed by server id
+    @param commands : Dict of lists of commands, keyed by server id
+    Returns a dict of (list of CommandResult, exception) tuples, keyed by server id
+    """
+    def run_server_commands(server_id):
+        return [execute_command(servers[server_id], command) for command in commands[server_id]]
+
+    return run_in_parallel(dict((server_id, lambda server_id=server_id: run_server_commands(server_id)) for server_id in commands), max_workers=max_workers)
+
+
+def write_configuration_file(params, filename, new_contents):
+    """
+    Writes contents in a configuration file
+    Return True if the file has been modified, False instead
+    """
+    return bool(sync_configuration_files(params, {filename: new_contents}))
+
+
+def _encode(contents):
+    if isinstance(contents, unicode):
+        return contents.encode('utf-8')
+    return contents
+
+
+def content_hash(contents):
+    """
+    Returns the MD5 hash of the contents, as computed by md5sum
+    """
+    return hashlib.md5(_encode(contents)).hexdigest()
+
+
+@instrumentation.timed('read_hashes')
+def get_file_hashes(params, filenames):
+    """
+    Returns a dict of MD5 hashes of the existing files, keyed by filename
+    Remote hashes are computed with a single command for all directories containing the files
+    """
+    hashes = {}
+    if params['local']:
+        for filename in filenames:
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as config_file:
+                    hashes[filename] = hashlib.md5(config_file.read()).hexdigest()
+        return hashes
+
+    directories = sorted(set(os.path.dirname(filename) for filename in filenames))
+    # Missing directories make find fail, but the hashes of the other ones are still listed
+    output = execute_command(params, ['find'] + directories + ['-maxdepth', '1', '-type', 'f', '-exec', 'md5sum', '{}', '+'], log_output=False, check=False).stdout
+    for line in output.splitlines():
+        if line:
+            file_hash, filename = line.split(None, 1)
+            hashes[filename] = file_hash
+
+    return hashes
+
+
+def sync_configuration_files(params, files):
+    """
+    Writes the files whose contents differ from the existing ones
+    Changed files are uploaded in temporary files, then all renamed at once
+    @param files : Dict of file contents, keyed by filename, None contents remove the file
+    Returns the list of changed or removed filenames
+    """
+    files = dict((filename, None if contents is None else _encode(contents)) for filename, contents in files.items())
+    hashes = get_file_hashes(params, files.keys())
+    changed = sorted(filename for filename, contents in files.items() if contents is not None and hashes.get(filename) != content_hash(contents))
+    removed = sorted(filename for filename, contents in files.items() if contents is None and filename in hashes)
+    if not changed and not removed:
+        return []
+
+    with instrumentation.span('write_files', params['name']):
+        if params['local']:
+            _sync_files(open, os.rename, os.remove, files, changed, removed)
+        else:
+            with ssh_connection(params) as connection:
+                _sync_files(connection.sftp.open, connection.sftp.posix_rename, connection.sftp.remove, files, changed, removed)
+
+    return sorted(changed + removed)
+
+
+def _sync_files(openfile, rename, remove, files, changed, removed):
+    """
+    Uploads the changed files in temporary files, then renames them and removes the removed files
+    """
+    temporary_filenames = {}
+    try:
+        for filename in changed:
+            temporary_filename = os.path.join(os.path.dirname(filename), '.%s.tmp' % os.path.basename(filename))
+            temporary_filenames[filename] = temporary_filename
+            with closing(openfile(temporary_filename, 'wb')) as config_file:
+                config_file.write(files[filename])
+    except:
+        # Don't leave partial uploads
+        for temporary_filename in temporary_filenames.values():
+            try:
+                remove(temporary_filename)
+            except (IOError, OSError):
+                pass
+        raise
+
+    for filename in changed:
+        rename(temporary_filenames[filename], filename)
+    for filename in removed:
+        remove(filename)
+
+
+def list_pg_clusters(params):
+    """
+    Returns a dict of the online status of the PostgreSQL clusters of the server version, keyed by cluster name
+    """
+    clusters = {}
+    for line in execute_command(params, ['/usr/bin/pg_lsclusters', '-h'], log_output=False).stdout.splitlines():
+        columns = line.split()
+        if len(columns) >= 4 and columns[0] == params['postgresql_version']:
+            clusters[columns[1]] = columns[3] == 'online'
+
+    return clusters
+
+
+@instrumentation.timed('create_pg_clusters')
+def create_pg_clusters(params, clusters):
+    """
+    Create and start the missing PostgreSQL clusters, as many at a time as the server has SSH connections
+    @param clusters : List of (port, cluster name) tuples
+    Returns the list of created cluster names
+    """
+    existing = list_pg_clusters(params)
+    missing = [(port, cluster_name) for port, cluster_name in clusters if cluster_name not in existing]
+
+    def create(port, cluster_name):
+        logger.info('%s - Create PostgreSQL Cluster' % cluster_name)
+        with instrumentation.span('pg_createcluster', params['name'], cluster_name):
+            execute_command(params, [
+                '/usr/bin/sudo',
+                '/usr/bin/pg_createcluster',
+                '--start',
+                '-p', str(port),
+                '-s', params['postgresql_pid_path'],
+                '-u', params['system_username'],
+                params['postgresql_version'],
+                cluster_name,
+            ])
+
+    _run_all(dict((cluster_name, lambda port=port, cluster_name=cluster_name: create(port, cluster_name)) for port, cluster_name in missing), params['ssh_pool_size'])
+    return [cluster_name for port, cluster_name in missing]
+
+
+@instrumentation.timed('control_pg_clusters')
+def control_pg_clusters(params, action, cluster_names):
+    """
+    Start, stop or drop PostgreSQL clusters, clusters already in the requested state are left untouched
+    @param action : 'start', 'stop' or 'drop'
+    """
+    existing = list_pg_clusters(params)
+    if action == 'start':
+        cluster_names = [cluster_name for cluster_name in cluster_names if existing.get(cluster_name) is False]
+    elif action == 'stop':
+        cluster_names = [cluster_name for cluster_name in cluster_names if existing.get(cluster_name)]
+    else:
+        cluster_names = [cluster_name for cluster_name in cluster_names if cluster_name in existing]
+
+    def control(cluster_name):
+        if action == 'drop':
+            command = ['/usr/bin/sudo', '/usr/bin/pg_dropcluster', '--stop', params['postgresql_version'], cluster_name]
+        else:
+            command = ['/usr/bin/sudo', '/usr/bin/pg_ctlcluster', params['postgresql_version'], cluster_name, action]
+        execute_command(params, command)
+
+    _run_all(dict((cluster_name, lambda cluster_name=cluster_name: control(cluster_name)) for cluster_name in cluster_names), params['ssh_pool_size'])
+    return cluster_names
+
+
+def remove_filestores(params, paths):
+    """
+    Remove filestores of the server, with a single command
+    """
+    paths = [path for path in paths if path.startswith(params['filestores_path'] + '/')]
+    if paths:
+        execute_command(params, ['rm', '-rf', '--'] + paths)
+
+    return paths
+
+
+def deploy_wakeup_script(params):
+    """
+    Write the wake-up script called by the apache vhosts of the sleeping instances
+    The script contains the Supervisor credentials, so it and its directory are only readable by apache
+    Returns True if the script changed
+    """
+    if not sync_configuration_files(params, {params['wakeup_script_path']: WAKEUP_SCRIPT % params}):
+        return False
+
+    paths = [os.path.dirname(params['wakeup_script_path']), params['wakeup_script_path']]
+    execute_command(params, ['chgrp', '--', params['apache_group']] + paths)
+    execute_command(params, ['chmod', '0750', '--'] + paths)
+    return True
+
+
+@instrumentation.timed('sleep_idle_instances')
+def sleep_idle_instances(params, access_logs, idle_timeout):
+    """
+    Stop the running instances which received no request since idle_timeout seconds
+    The last activity of an instance is the last write in its access log, or the start of its process
+    @param access_logs : Dict of access log paths, keyed by instance name
+    Returns a dict of dicts containing the last_activity timestamp and the sleeping state, keyed by instance name
+    """
+    # Clock of the server, and modification time of the access logs
+    script = 'date +%%s; stat -c "%%Y %%n" %s 2>/dev/null; true' % ' '.join(pipes.quote(path) for path in sorted(access_logs.values()))
+    lines = execute_command(params, ['/bin/sh', '-c', script], log_output=False).stdout.splitlines()
+    now = int(lines[0])
+    log_times = dict((path, int(mtime)) for mtime, path in (line.split(None, 1) for line in lines[1:] if line))
+
+    with supervisor_client(params) as client:
+        processes = dict((process['group'], process) for process in client.supervisor.getAllProcessInfo())
+
+        last_activities = {}
+        idle = []
+        for instance_name, access_log in access_logs.items():
+            process = processes.get(instance_name)
+            if process is None:
+                continue
+            last_activities[instance_name] = max(log_times.get(access_log, 0), process['start'])
+            if process['statename'] == 'RUNNING' and now - last_activities[instance_name] > idle_timeout:
+                idle.append(instance_name)
+
+        failures = {}
+        calls = [('supervisor.stopProcessGroup', [instance_name]) for instance_name in sorted(idle)]
+        if calls:
+            logger.info('%s - Stop idle instances : %s' % (params['name'], ', '.join(sorted(idle))))
+        _check_supervisor_results(calls, supervisor_multicall(client, calls), failures)
+
+    result = {}
+    for instance_name, last_activity in last_activities.items():
+        stopped = processes[instance_name]['statename'] in ('STOPPED', 'EXITED')
+        result[instance_name] = {
+            'last_activity': last_activity,
+            'sleeping': stopped or instance_name in idle and instance_name not in failures,
+        }
+
+    return result
+
+
+def _quote_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _quote_literal(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def _pg_command(params, port, command):
+    """
+    Returns the shell command running a PostgreSQL client on a cluster of the server, as the owner of the clusters
+    """
+    return ' '.join(pipes.quote(argument) for argument in ['/usr/bin/sudo', '-u', params['system_username']] + command[:1] + ['-h', params['postgresql_pid_path'], '-p', str(port)] + command[1:])
+
+
+def _psql(params, port, statements):
+    """
+    Execute SQL statements in the postgres database of a cluster of the server, each one in its own transaction
+    Statements are executed as the owner of the clusters, which is their superuser
+    Returns the output of the statements, one unaligned row per line
+    """
+    script = "printf '%%s\\n' %s | %s" % (
+        ' '.join(pipes.quote(statement) for statement in statements),
+        _pg_command(params, port, ['/usr/bin/psql', '-X', '-q', '-A', '-t', '-v', 'ON_ERROR_STOP=1', '-d', 'postgres']),
+    )
+    return execute_command(params, ['/bin/sh', '-c', script], log_output=False).stdout
+
+
+@instrumentation.timed('create_pg_roles')
+def create_pg_roles(params, roles):
+    """
+    Create the missing roles of the instances in the shared PostgreSQL cluster of the server
+    @param roles : List of (username, password) tuples
+    Returns the list of created usernames
+    """
+    existing = set(_psql(params, params['shared_cluster_port'], ['SELECT rolname FROM pg_roles;']).splitlines())
+    missing = [(username, password) for username, password in roles if username not in existing]
+    if missing:
+        _psql(params, params['shared_cluster_port'], ['CREATE ROLE %s LOGIN CREATEDB PASSWORD %s;' % (_quote_identifier(username), _quote_literal(password)) for username, password in missing])
+
+    return [username for username, password in missing]
+
+
+@instrumentation.timed('drop_pg_roles')
+def drop_pg_roles(params, usernames):
+    """
+    Drop the roles of the instances from the shared PostgreSQL cluster of the server, with the databases they own
+    Returns the list of dropped databases
+    """
+    if not usernames:
+        return []
+
+    port = params['shared_cluster_port']
+    databases = _psql(params, port, ['SELECT database.datname FROM pg_database database JOIN pg_roles role ON role.oid = database.datdba WHERE role.rolname IN (%s);' % ', '.join(_quote_literal(username) for username in usernames)]).splitlines()
+
+    statements = []
+    if databases:
+        # Close the connections kept by pgbouncer, the column was renamed in PostgreSQL 9.2
+        pid_column = map(int, params['postgresql_version'].split('.')[:2]) < [9, 2] and 'procpid' or 'pid'
+        statements.append('SELECT pg_terminate_backend(%s) FROM pg_stat_activity WHERE datname IN (%s);' % (pid_column, ', '.join(_quote_literal(database) for database in databases)))
+        statements.extend('DROP DATABASE IF EXISTS %s;' % _quote_identifier(database) for database in databases)
+    statements.extend('DROP ROLE IF EXISTS %s;' % _quote_identifier(username) for username in usernames)
+    _psql(params, port, statements)
+
+    return databases
+
+
+def pgbouncer_files(params, users):
+    """
+    Returns the configuration files of the pgbouncer of the server, keyed by filename
+    @param users : List of (username, password) tuples of the instances using the shared cluster
+    """
+    return {
+        '%s/pgbouncer.ini' % params['pgbouncer_path']: PGBOUNCER_CONFIG % params,
+        '%s/userlist.txt' % params['pgbouncer_path']: ''.join('"%s" "%s"\n' % (username.replace('"', '""'), password.replace('"', '""')) for username, password in sorted(users)),
+        '%s/%spgbouncer.conf' % (params['supervisor_path'], params['prefix']): PGBOUNCER_PROGRAM % params,
+    }
+
+
+def reload_pgbouncer(params):
+    """
+    Make pgbouncer read its configuration and users list again
+    """
+    # pgbouncer may not be started yet, it will then read the new files when starting
+    return run_command(params, ['/bin/sh', '-c', 'kill -HUP $(cat %s)' % pipes.quote('%s/pgbouncer.pid' % params['pgbouncer_path'])], log_output=False).success
+
+
+def list_databases(params, port, owner=None):
+    """
+    Returns the names of the databases of a cluster of the server, except the templates and the postgres database
+    @param owner : Name of a role, to list only the databases it owns
+    """
+    query = "SELECT database.datname FROM pg_database database JOIN pg_roles role ON role.oid = database.datdba WHERE NOT database.datistemplate AND database.datname != 'postgres'"
+    if owner:
+        query += ' AND role.rolname = %s' % _quote_literal(owner)
+
+    return sorted(_psql(params, port, [query + ';']).splitlines())
+
+
+def _check_backup_path(params, path):
+    if not path.startswith(params['backups_path'] + '/'):
+        raise ValueError('%s is not in the backups directory of %s' % (path, params['name']))
+
+
+@instrumentation.timed('backup')
+def backup_instance(params, source, destination, previous=None):
+    """
+    Dump the databases and copy the filestore of an instance in a new backup directory of the server
+    Dumps are streamed to the backup directory by the server itself, unchanged files of the filestore are hard links to the previous backup
+    The backup is written in a temporary directory, renamed when complete
+    @param source : Dict containing the cluster_port, the owner of the databases (None for all databases of the cluster) and the filestore_path of the instance
+    @param previous : Directory of the previous backup of the instance
+    Returns a dict containing the names of the saved databases, the size in KB of the files not shared with the previous backup, and the duration of the copy
+    """
+    _check_backup_path(params, destination)
+    databases = list_databases(params, source['cluster_port'], owner=source['owner'])
+
+    temporary = '%s.tmp' % destination
+    commands = [
+        'set -e',
+        # A previous attempt may have left a partial or complete copy
+        'rm -rf -- %s %s' % (pipes.quote(temporary), pipes.quote(destination)),
+        'mkdir -p -- %s/databases' % pipes.quote(temporary),
+    ]
+    for database in databases:
+        commands.append('%s > %s' % (
+            _pg_command(params, source['cluster_port'], ['/usr/bin/pg_dump', '-Fc', database]),
+            pipes.quote('%s/databases/%s.dump' % (temporary, database)),
+        ))
+    link_dest = previous and ['--link-dest=%s/filestore' % previous] or []
+    commands.extend([
+        'mkdir -p -- %s/filestore' % pipes.quote(temporary),
+        'if [ -d %s ]; then %s; fi' % (pipes.quote(source['filestore_path']), ' '.join(pipes.quote(argument) for argument in ['rsync', '-a', '--delete'] + link_dest + ['%s/' % source['filestore_path'], '%s/filestore/' % temporary])),
+        'mv -- %s %s' % (pipes.quote(temporary), pipes.quote(destination)),
+        # Files hard linked to the previous backup are only counted for the first directory, which may have been removed
+        'du -sk -- %s 2>/dev/null || true' % ' '.join(pipes.quote(path) for path in filter(None, [previous, destination])),
+    ])
+
+    logger.info('%s - Back up %s' % (params['name'], ', '.join(databases) or 'filestore'))
+    result = execute_command(params, ['/bin/sh', '-c', '\n'.join(commands)], timeout=params['backup_timeout'], log_output=False)
+    size = int(result.stdout.splitlines()[-1].split()[0])
+
+    return {'databases': databases, 'size': size, 'duration': result.duration}
+
+
+@instrumentation.timed('restore')
+def restore_instance(params, backup_path, target):
+    """
+    Restore the databases and the filestore of a backup of the server into an instance without databases
+    Dumps are read by the server itself, from the backup directory
+    @param target : Dict containing the cluster_port, the owner of the restored databases, the filestore_path and the databases of the instance, as a dict of new names keyed by name in the backup
+    """
+    _check_backup_path(params, backup_path)
+
+    # A previous attempt may have left partially restored databases
+    if target['databases']:
+        _psql(params, target['cluster_port'], ['DROP DATABASE IF EXISTS %s;' % _quote_identifier(new_name) for new_name in sorted(target['databases'].values())])
+
+    commands = ['set -e']
+    for database, new_name in sorted(target['databases'].items()):
+        commands.append(_pg_command(params, target['cluster_port'], ['/usr/bin/createdb', '-T', 'template0', '-O', target['owner'], new_name]))
+        commands.append('%s < %s' % (
+            _pg_command(params, target['cluster_port'], ['/usr/bin/pg_restore', '--no-owner', '--role=%s' % target['owner'], '-d', new_name]),
+            pipes.quote('%s/databases/%s.dump' % (backup_path, database)),
+        ))
+    commands.extend([
+        'mkdir -p -- %s' % pipes.quote(target['filestore_path']),
+        ' '.join(pipes.quote(argument) for argument in ['rsync', '-a', '--delete', '%s/filestore/' % backup_path, '%s/' % target['filestore_path']]),
+    ])
+
+    logger.info('%s - Restore %s' % (params['name'], backup_path))
+    execute_command(params, ['/bin/sh', '-c', '\n'.join(commands)], timeout=params['backup_timeout'], log_output=False)
+    return sorted(target['databases'].values())
+
+
+def remove_backups(params, paths):
+    """
+    Remove backup directories of the server, with a single command
+    """
+    paths = [path for path in paths if path.startswith(params['backups_path'] + '/')]
+    if paths:
+        execute_command(params, ['rm', '-rf', '--'] + paths + ['%s.tmp' % path for path in paths])
+
+    return paths
+
+
+def _run_all(functions, max_workers):
+    """
+    Call the functions in parallel, and raise the first error after all calls ended
+    """
+    for key, (result, exception) in sorted(run_in_parallel(functions, max_workers=max_workers).items()):
+        if exception is not None:
+            raise exception
+
+
+@contextmanager
+def supervisor_client(params):
+    """
+    Yields the cached Supervisor XML-RPC client of the server
+    """
+    with supervisor_clients.client(params['id'], params['supervisor_url']) as client:
+        yield client
+
+
+def supervisor_multicall(client, calls):
+    """
+    Sends all calls in a single request
+    @param calls : List of (method name, parameters list) tuples
+    Returns the list of results, faults are returned as dicts containing faultCode and faultString
+    """
+    if not calls:
+        return []
+
+    return client.system.multicall([{'methodName': method_name, 'params': parameters} for method_name, parameters in calls])
+
+
+@instrumentation.timed('wait_ready')
+def wait_for_port(params, port, timeout):
+    """
+    Wait until something listens on the port of the server, on its loopback interface
+    Remote ports are checked through the SSH connection
+    Returns True if the port answered before the timeout
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if params['local']:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                return True
+
+            with ssh_connection(params) as connection:
+                # A refused channel doesn't break the transport, keep the connection in the pool
+                try:
+                    connection.client.get_transport().open_channel('direct-tcpip', ('127.0.0.1', port), ('127.0.0.1', 0)).close()
+                    return True
+                except paramiko.ChannelException:
+                    pass
+        except socket.error:
+            pass
+
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.5)
+
+
+def _check_supervisor_results(calls, results, failures):
+    """
+    Stores the failed operations of a multicall in the failures dict, keyed by process name
+    """
+    for (method_name, parameters), result in zip(calls, results):
+        if isinstance(result, dict) and 'faultCode' in result:
+            logger.error('%s - %s failed : %s' % (parameters[0], method_name, result['faultString']))
+            failures.setdefault(parameters[0], []).append('%s : %s' % (method_name, result['faultString']))
+        elif isinstance(result, list):
+            # stopProcessGroup returns the status of each process of the group
+            for process_status in result:
+                if process_status.get('status') != 80:
+                    logger.error('%s - %s failed : %s' % (process_status.get('name'), method_name, process_status.get('description')))
+                    failures.setdefault(parameters[0], []).append('%s : %s' % (method_name, process_status.get('description')))
+
+
+@instrumentation.timed('supervisor_reload')
+def reload_supervisor_configuration(params, force_restart=None, ports=None):
+    """
+    Reload supervisor configuration, then stop old services and start new services
+    Services are restarted by batches of params['restart_batch_size'] (all at once if 0), using one multicall per batch
+    Between two batches, we wait until the OpenERP port of each restarted service answers
+    @param force_restart : List of instance names to restart, even if nothing changed in supervisor configuration
+    @param ports : Dict of OpenERP ports, keyed by instance name, used to check that restarted services are ready
+    Returns a dict of lists of failed operations, keyed by process name
+    """
+    if force_restart is None:
+        force_restart = []
+    if ports is None:
+        ports = {}
+
+    failures = {}
+    # The client is only held during the calls, other threads can use it while the instances start
+    with supervisor_client(params) as client:
+        # Reload supervisor configuration
+        added, changed, removed = client.supervisor.reloadConfig()[0]
+
+        to_stop = set(changed + removed + force_restart) - set(added)
+        to_start = sorted(set(added + changed + force_restart) - set(removed))
+
+        # Stop removed services at once
+        calls = []
+        for process_name in sorted(to_stop - set(to_start)):
+            calls.append(('supervisor.stopProcessGroup', [process_name]))
+            calls.append(('supervisor.removeProcessGroup', [process_name]))
+        _check_supervisor_results(calls, supervisor_multicall(client, calls), failures)
+
+    # Restart changed services and start added services, batch by batch
+    batch_size = params['restart_batch_size'] or len(to_start)
+    for index in range(0, len(to_start), batch_size or 1):
+        batch = to_start[index:index + batch_size]
+        calls = []
+        for process_name in batch:
+            if process_name in to_stop:
+                calls.append(('supervisor.stopProcessGroup', [process_name]))
+                calls.append(('supervisor.removeProcessGroup', [process_name]))
+            calls.append(('supervisor.addProcessGroup', [process_name]))
+        with supervisor_client(params) as client:
+            _check_supervisor_results(calls, supervisor_multicall(client, calls), failures)
+
+        # Wait for the batch to be ready before restarting the next one
+        if params['restart_batch_size'] and index + batch_size < len(to_start):
+            for process_name in batch:
+                if process_name in ports and process_name not in failures and not wait_for_port(params, ports[process_name], params['restart_timeout']):
+                    logger.error('%s - Not ready after %d seconds' % (process_name, params['restart_timeout']))
+                    failures.setdefault(process_name, []).append('Not ready after %d seconds' % params['restart_timeout'])
+
+    return failures
+
+
+@instrumentation.timed('apache_reload')
+def reload_apache_configuration(params):
+    """
+    Test apache configuration, then reload it
+    Vhosts of this module breaking the configuration are moved in a ".disabled" directory next to the apache path, to reload the other ones
+    Returns a dict containing the duration of the reload, the disabled vhosts, and the error which prevented the reload
+    """
+    start = time.time()
+    disabled = []
+    while True:
+        result = run_command(params, ['/usr/bin/sudo', '/usr/sbin/apache2ctl', 'configtest'], log_output=False)
+        stderr = result.stderr
+        if result.success:
+            break
+        if result.timed_out:
+            stderr = 'Configuration test timed out'
+
+        # Unknown error, keep the running configuration
+        match = APACHE_ERROR_FILE.search(stderr)
+        if not match or not match.group(1).startswith(params['apache_path'] + '/') or len(disabled) >= MAX_DISABLED_VHOSTS:
+            logger.error('%s - Apache configuration test failed : %s' % (params['name'], stderr))
+            return {'duration': time.time() - start, 'disabled': disabled, 'error': stderr}
+
+        filename = match.group(1)
+        logger.error('%s - Disable %s : %s' % (params['name'], filename, stderr))
+        disabled_path = '%s.disabled' % params['apache_path']
+        execute_command(params, ['mkdir', '-p', disabled_path])
+        execute_command(params, ['mv', '-f', filename, disabled_path])
+        disabled.append(filename)
+
+    execute_command(params, [
+        '/usr/bin/sudo',
+        '/usr/sbin/service',
+        'apache2',
+        'reload',
+    ])
+
+    return {'duration': time.time() - start, 'disabled': disabled, 'error': False}
+
+
+@instrumentation.timed('collect_metrics')
+def collect_metrics(params, instances, disk_usage=True):
+    """
+    Read the state and resource usage of the instances of a server
+    Uses one Supervisor call and one command, whatever the number of instances
+    @param instances : Dict of dicts containing the cluster_name, postgresql_version and filestore_path, keyed by instance name
+    @param disk_usage : Measure the size of the filestores, which reads all their files
+    Returns a dict of dicts containing the process_state, pg_alive, memory_rss (MB), disk_usage (MB, None when not measured),
+    and the cpu_pid, cpu_time and cpu_uptime (seconds of processor time used by the process since its start, at the given server uptime), keyed by instance name
+    """
+    with supervisor_client(params) as client:
+        processes = dict((process['group'], process) for process in client.supervisor.getAllProcessInfo())
+
+    pids = [str(process['pid']) for name, process in processes.items() if name in instances and process['pid']]
+    filestore_paths = sorted(instance['filestore_path'] for instance in instances.values())
+    script = '; '.join([
+        '/usr/bin/pg_lsclusters -h',
+        'echo %s' % METRICS_SEPARATOR,
+        pids and 'ps -o pid=,rss= -p %s' % ','.join(pids) or 'true',
+        'echo %s' % METRICS_SEPARATOR,
+        # Processor time is read in clock ticks since the start of the process, the uptime is read just before to date the samples
+        'getconf CLK_TCK; cut -d " " -f 1 /proc/uptime',
+        'echo %s' % METRICS_SEPARATOR,
+        pids and 'cat %s 2>/dev/null' % ' '.join('/proc/%s/stat' % pid for pid in pids) or 'true',
+        'echo %s' % METRICS_SEPARATOR,
+        disk_usage and filestore_paths and 'du -sk %s 2>/dev/null' % ' '.join(pipes.quote(path) for path in filestore_paths) or 'true',
+    ])
+    # ps, cat and du fail when a process stopped or a filestore doesn't exist yet, the available values are still used
+    result = run_command(params, ['/bin/sh', '-c', script], log_output=False)
+    if result.timed_out:
+        raise CommandError(result)
+    clusters, usages, clock, stats, disk_usages = (result.stdout.split(METRICS_SEPARATOR + '\n') + ['', '', '', ''])[:5]
+
+    online_clusters = set()
+    for line in clusters.splitlines():
+        columns = line.split()
+        if len(columns) >= 4 and columns[3] == 'online':
+            online_clusters.add((columns[0], columns[1]))
+
+    process_usages = {}
+    for line in usages.splitlines():
+        pid, rss = line.split()
+        process_usages[int(pid)] = int(rss) / 1024.0
+
+    clock_ticks, uptime = clock.split()
+    process_times = {}
+    for line in stats.splitlines():
+        # The process name is between parentheses and may contain spaces, utime and stime are the 14th and 15th fields
+        pid, name = line.split(None, 1)
+        columns = name.rsplit(')', 1)[1].split()
+        process_times[int(pid)] = (int(columns[11]) + int(columns[12])) / float(clock_ticks)
+
+    filestore_usages = {}
+    for line in disk_usages.splitlines():
+        size, path = line.split(None, 1)
+        filestore_usages[path] = int(size) / 1024.0
+
+    metrics = {}
+    for instance_name, instance in instances.items():
+        process = processes.get(instance_name, {})
+        pid = process.get('pid')
+        metrics[instance_name] = {
+            'process_state': process.get('statename', 'UNKNOWN'),
+            'pg_alive': (instance['postgresql_version'], instance['cluster_name']) in online_clusters,
+            'memory_rss': process_usages.get(pid, 0.0),
+            'cpu_pid': pid if pid in process_times else 0,
+            'cpu_time': process_times.get(pid, 0.0),
+            'cpu_uptime': float(uptime),
+            'disk_usage': filestore_usages.get(instance['filestore_path'], 0.0) if disk_usage else None,
+        }
+
+    return metrics
+
+
+def run_in_parallel(functions, max_workers=MAX_WORKERS):
+    """
+    Call the functions in a pool of worker threads
+    @param functions : Dict of functions, called without arguments
+    Returns a dict of (result, exception) tuples, with the same keys as functions
+    """
+    results = {}
+    # Spans of the worker threads are recorded in the trace of the caller
+    trace = instrumentation.current_trace()
+
+    def run(key):
+        try:
+            with instrumentation.activate(trace):
+                results[key] = (functions[key](), None)
+        except Exception, e:
+            logger.exception('Error while processing %s' % (key,))
+            results[key] = (None, e)
+
+    # Avoid creating threads when there is nothing to parallelize
+    if len(functions) <= 1 or max_workers <= 1:
+        for key in functions:
+            run(key)
+        return results
+
+    keys = Queue.Queue()
+    for key in functions:
+        keys.put(key)
+
+    def worker():
+        while True:
+            try:
+                key = keys.get_nowait()
+            except Queue.Empty:
+                return
+            run(key)
+
+    threads = [threading.Thread(target=worker) for index in range(min(max_workers, len(functions)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
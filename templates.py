@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    hosting module for OpenERP, Allow to very simply create and manage new OpenERP instances
+#    Copyright (C) 2014 SYLEAM Info Services (<http://www.Syleam.fr/>)
+#              Sylvain Garancher <sylvain.garancher@syleam.fr>
+#
+#    This file is a part of hosting
+#
+#    hosting is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    hosting is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import re
+import hashlib
+import threading
+
+# Values available in the configuration file templates, with an example of each type
+SAMPLE_VALUES = {
+    'root_path': '/srv/openerp/hosting/variants/variant',
+    'admin_passwd': 'admin',
+    'db_host': '/srv/openerp/hosting/pg_pid',
+    'db_port': 20001,
+    'db_user': 'openerp',
+    'db_password': 'False',
+    'port': 10001,
+    'instance_name': 'instance1',
+    'system_username': 'openerp',
+    'virtualenv_path': '/srv/openerp/hosting/virtualenvs/variant',
+    'apache_port': 443,
+    'dbname': 'hosting',
+    'domain_name': 'example.com',
+    'instance_url': 'instance1.hosting.example.com',
+    'access_log': '/var/log/apache2/instance1.log',
+    'wakeup_script': '/srv/openerp/hosting/cgi-bin/hosting-wakeup',
+}
+
+# Escaped placeholders like %%(name)s are plain text, a placeholder follows an even number of % signs
+PLACEHOLDER = re.compile(r'(?<!%)(?:%%)*%\(([^)]*)\)')
+
+# Maximum number of compiled templates kept in memory
+CACHE_SIZE = 256
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class Template(object):
+    """
+    Configuration file template, parsed and validated once
+    """
+    def __init__(self, text):
+        self.text = text
+        self.placeholders = frozenset(PLACEHOLDER.findall(text))
+        self.error = self._validate()
+
+    def _validate(self):
+        """
+        Returns the error message of an invalid template, or None
+        """
+        unknown = sorted(self.placeholders - set(SAMPLE_VALUES))
+        if unknown:
+            return 'Unknown placeholders : %s' % ', '.join(unknown)
+
+        # Check the format specifications (type of the values, misplaced % signs...)
+        try:
+            self.text % SAMPLE_VALUES
+        except (TypeError, ValueError, KeyError), e:
+            return 'Invalid format : %s' % e
+
+        return None
+
+    def check(self):
+        if self.error:
+            raise TemplateError(self.error)
+
+    def render(self, values):
+        return self.text % values
+
+    def render_all(self, values_list):
+        """
+        Renders the template once per dict of values
+        """
+        self.check()
+        text = self.text
+        return [text % values for values in values_list]
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_template(text):
+    """
+    Returns the compiled template of the text, from the cache if it was already compiled
+    """
+    key = hashlib.md5(text.encode('utf-8') if isinstance(text, unicode) else text).hexdigest()
+    template = _cache.get(key)
+    if template is None:
+        template = Template(text)
+        with _cache_lock:
+            if len(_cache) >= CACHE_SIZE:
+                _cache.clear()
+            _cache[key] = template
+
+    return template
+
+
+def check_template(text):
+    """
+    Raises a TemplateError if the text is not a valid template
+    """
+    get_template(text).check()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4: